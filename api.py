@@ -1,7 +1,14 @@
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+from binascii import Error as BinasciiError
 from uuid import uuid4
 
 import db_api
-from utils import sha1
+from cache import TaggedLRUCache, MISSING
+from utils import sha1, parse_datetime
+
+# Formatted pages of entity comments tagged by entity id; writes in this process drop pages of their entity,
+# TTL bounds how long pages may miss writes made by other processes
+response_cache = TaggedLRUCache(size=1000, ttl=5)
 
 
 class APIException(Exception):
@@ -12,21 +19,55 @@ def _create_comment_identifiers(text):
     return str(uuid4()), sha1(text)
 
 
-async def add_comment(connection, entity_type, entity_token, user_token, text):
-    entity_type_id = await db_api.get_or_create_entity_type(connection, entity_type)
-    entity_id = await db_api.get_or_create_entity(connection, entity_type_id, entity_token)
-    user_id = await db_api.get_or_create_user(connection, user_token)
+def _encode_cursor(created, comment_id):
+    return urlsafe_b64encode("{}|{}".format(created.isoformat(), comment_id).encode("utf-8")).decode("ascii")
+
+
+def _decode_cursor(cursor):
+    if not cursor:
+        return None
+
+    try:
+        created, comment_id = urlsafe_b64decode(cursor.encode("ascii")).decode("utf-8").split("|")
+        return parse_datetime(created), int(comment_id)
+    except (BinasciiError, UnicodeError, ValueError, OverflowError):
+        raise APIException("Invalid cursor '{}'".format(cursor))
+
+
+def _encode_path_cursor(path):
+    # Replies are ordered by path: the cursor keeps the path itself, so it stays valid when its comment is gone
+    return urlsafe_b64encode(path.encode("utf-8")).decode("ascii")
+
+
+def _decode_path_cursor(cursor):
+    if not cursor:
+        return None
+
+    try:
+        path = urlsafe_b64decode(cursor.encode("ascii")).decode("ascii")
+    except (BinasciiError, UnicodeError, ValueError):
+        raise APIException("Invalid cursor '{}'".format(cursor))
+
+    if not path or len(path) % db_api.PATH_SEGMENT_LENGTH or set(path) - set("0123456789/"):
+        raise APIException("Invalid cursor '{}'".format(cursor))
+
+    return path
+
 
+async def add_comment(connection, entity_type, entity_token, user_token, text):
     result, text_hash = _create_comment_identifiers(text)
-    await db_api.insert_comment(
+    _, entity_id = await db_api.insert_entity_comment(
         connection,
-        entity_id=entity_id,
-        user_id=user_id,
+        type_name=entity_type,
+        entity_token=entity_token,
+        user_token=user_token,
         unique_key=result,
         text=text,
         text_hash=text_hash
     )
 
+    response_cache.invalidate_tag(entity_id)
+
     return result
 
 
@@ -46,9 +87,70 @@ async def reply_comment(connection, parent_comment_token, user_token, text):
         unique_key=result,
         text=text,
         text_hash=text_hash,
-        parent_comment_id=comment["id"]
+        parent_comment_id=comment["id"],
+        parent_path=comment["path"]
     )
 
+    response_cache.invalidate_tag(comment["entity"])
+
+    return result
+
+
+async def add_comments(connection, comments):
+    if not comments:
+        return []
+
+    parents = await db_api.get_comments_by_keys(
+        connection, {item["comment_token"] for item in comments if "comment_token" in item}
+    )
+
+    for idx, item in enumerate(comments):
+        if "comment_token" in item:
+            if item["comment_token"] not in parents:
+                raise APIException("Comment with token '{}' was not found".format(item["comment_token"]))
+        elif "type" not in item or "entity" not in item:
+            raise APIException("Comment #{} must reply either to an entity or to a comment".format(idx))
+
+    entity_comments = [item for item in comments if "comment_token" not in item]
+
+    type_ids = await db_api.get_or_create_entity_types(
+        connection, {item["type"] for item in entity_comments}
+    )
+    entity_ids = await db_api.get_or_create_entities(
+        connection, {(type_ids[item["type"].lower()], item["entity"]) for item in entity_comments}
+    )
+    user_ids = await db_api.get_or_create_users(
+        connection, {item["user_token"] for item in comments}
+    )
+
+    result = []
+    rows = []
+    for item in comments:
+        unique_key, text_hash = _create_comment_identifiers(item["text"])
+
+        if "comment_token" in item:
+            parent = parents[item["comment_token"]]
+            entity_id, parent_comment_id, parent_path = parent["entity"], parent["id"], parent["path"]
+        else:
+            entity_id = entity_ids[(type_ids[item["type"].lower()], item["entity"])]
+            parent_comment_id, parent_path = None, ""
+
+        rows.append({
+            "entity_id": entity_id,
+            "user_id": user_ids[item["user_token"]],
+            "parent_comment_id": parent_comment_id,
+            "parent_path": parent_path,
+            "unique_key": unique_key,
+            "text": item["text"],
+            "text_hash": text_hash
+        })
+        result.append(unique_key)
+
+    await db_api.insert_comments(connection, rows)
+
+    for entity_id in {row["entity_id"] for row in rows}:
+        response_cache.invalidate_tag(entity_id)
+
     return result
 
 
@@ -71,19 +173,34 @@ async def edit_comment(connection, user_token, comment_unique_key, text):
         text_hash=sha1(text)
     )
 
+    response_cache.invalidate_tag(comment["entity"])
+
     return result
 
 
+async def get_comment_history(connection, comment_token):
+    comment = await db_api.get_comment_by_key(connection, comment_token)
+    if not comment:
+        raise APIException("Comment '{}' not found".format(comment_token))
+
+    return [
+        {
+            "text": item["text"],
+            "timestamp": str(item["timestamp"])
+        } for item in await db_api.get_comment_history(connection, comment["id"])
+    ]
+
+
 async def remove_comment(connection, user_token, comment_unique_key):
     comment = await _try_get_comment(connection, user_token, comment_unique_key)
     if not await db_api.delete_comment(connection, comment["id"]):
         raise APIException("Could not delete comment")
     else:
+        response_cache.invalidate_tag(comment["entity"])
         return True
 
 
-async def get_entity_comments(connection, entity_type, entity_token, limit, offset, with_replies,
-                              timestamp_from=None, timestamp_to=None):
+async def _get_entity_id(connection, entity_type, entity_token):
     type_id = await db_api.get_or_create_entity_type(connection, entity_type, create_if_none=False)
     if not type_id:
         raise APIException("Unknown entity type '{}'".format(entity_type))
@@ -92,25 +209,134 @@ async def get_entity_comments(connection, entity_type, entity_token, limit, offs
     if not entity_id:
         raise APIException("Entity '{}' was not found".format(entity_token))
 
+    return entity_id
+
+
+async def get_entity_comments(connection, entity_type, entity_token, limit, offset, with_replies,
+                              timestamp_from=None, timestamp_to=None, cursor=None, stream=False):
+    entity_id = await _get_entity_id(connection, entity_type, entity_token)
+
+    async for item in _entity_comments(connection, entity_id, limit, offset, with_replies,
+                                       timestamp_from, timestamp_to, cursor, stream):
+        yield item
+
+
+async def get_entity_comments_page(connection, entity_type, entity_token, limit, offset, with_replies,
+                                   timestamp_from=None, timestamp_to=None, cursor=None, version=None):
+    # `version` is the entity's ETag when the caller has it, pages of other versions are not reused then
+    key = ("entity_comments", entity_type.lower(), entity_token, with_replies, limit, offset,
+           timestamp_from, timestamp_to, cursor, version)
+
+    result = response_cache.get(key)
+    if result is MISSING:
+        generation = response_cache.generation
+        entity_id = await _get_entity_id(connection, entity_type, entity_token)
+
+        result = [
+            item async for item in _entity_comments(connection, entity_id, limit, offset, with_replies,
+                                                    timestamp_from, timestamp_to, cursor)
+        ]
+
+        response_cache.put(key, result, tag=entity_id, generation=generation)
+
+    return result
+
+
+async def _entity_comments(connection, entity_id, limit, offset, with_replies,
+                           timestamp_from=None, timestamp_to=None, cursor=None, stream=False):
     async for item in db_api.get_entity_comments(connection, entity_id, with_replies, limit, offset,
-                                                 timestamp_from, timestamp_to):
-        yield {
-            "text": item["text"],
-            "created": str(item["created"]),
-            "updated": str(item["updated"]),
-            "user": item["token"],
-            "key": item["key"],
-            "parent_key": item["parent_key"]
-        }
+                                                 timestamp_from, timestamp_to, _decode_cursor(cursor), stream):
+        result = _entity_comment(item)
+
+        if cursor is not None:
+            result["cursor"] = _encode_cursor(item["created"], item["id"])
+
+        yield result
+
+
+def _entity_comment(item):
+    return {
+        "text": item["text"],
+        "created": str(item["created"]),
+        "updated": str(item["updated"]),
+        "user": item["token"],
+        "key": item["key"],
+        "parent_key": item["parent_key"]
+    }
+
+
+async def get_entities_first_page(connection, entities, limit):
+    type_ids = await db_api.get_or_create_entity_types(
+        connection, {item["type"] for item in entities}, create_if_none=False
+    )
+
+    keys = [(type_ids.get(item["type"].lower()), item["entity"]) for item in entities]
+    entity_ids = await db_api.get_or_create_entities(
+        connection, {key for key in keys if key[0] is not None}, create_if_none=False
+    )
+
+    found_ids = set(entity_ids.values())
+    counters = await db_api.get_entities_counters(connection, found_ids)
+    pages = await db_api.get_entities_first_page(connection, found_ids, limit)
+
+    result = []
+    for item, key in zip(entities, keys):
+        entity_id = entity_ids.get(key, None)
+
+        result.append({
+            "type": item["type"],
+            "entity": item["entity"],
+            "count": counters[entity_id] if entity_id else {"comments": 0, "total": 0},
+            "comments": [_entity_comment(comment) for comment in pages[entity_id]] if entity_id else []
+        })
+
+    return result
+
+
+async def get_entity_counters(connection, entity_type, entity_token):
+    type_id = await db_api.get_or_create_entity_type(connection, entity_type, create_if_none=False)
+    if not type_id:
+        raise APIException("Unknown entity type '{}'".format(entity_type))
+
+    entity_id = await db_api.get_or_create_entity(connection, type_id, entity_token, create_if_none=False)
+    if not entity_id:
+        raise APIException("Entity '{}' was not found".format(entity_token))
+
+    return await db_api.get_entity_counters(connection, entity_id)
+
+
+async def get_entity_etag(connection, entity_type, entity_token):
+    entity_id = await _get_entity_id(connection, entity_type, entity_token)
+
+    return '"{}-{}-{}"'.format(*await db_api.get_entity_version(connection, entity_id))
+
+
+async def get_comment_etag(connection, comment_token):
+    # Replies of a comment change only with the version of its entity
+    comment = await db_api.get_comment_by_key(connection, comment_token)
+    if not comment:
+        raise APIException("Comment '{}' not found".format(comment_token))
 
+    return '"{}-{}-{}"'.format(*await db_api.get_entity_version(connection, comment["entity"]))
 
-async def get_user_comments(connection, user_token, limit=0, offset=0, timestamp_from=None, timestamp_to=None):
+
+async def get_user_counters(connection, user_token):
     user_id = await db_api.get_user_id_by_token(connection, user_token)
     if not user_id:
         raise APIException("User '{}' not found".format(user_token))
 
-    async for item in db_api.get_user_comments(connection, user_id, limit, offset, timestamp_from, timestamp_to):
-        yield {
+    return await db_api.get_user_counters(connection, user_id)
+
+
+async def get_user_comments(connection, user_token, limit=0, offset=0, timestamp_from=None, timestamp_to=None,
+                            cursor=None, stream=False):
+    user_id = await db_api.get_user_id_by_token(connection, user_token)
+    if not user_id:
+        raise APIException("User '{}' not found".format(user_token))
+
+    async for item in db_api.get_user_comments(connection, user_id, limit, offset, timestamp_from, timestamp_to,
+                                               _decode_cursor(cursor), stream):
+        result = {
             "text": item["text"],
             "created": str(item["created"]),
             "updated": str(item["updated"]),
@@ -118,14 +344,20 @@ async def get_user_comments(connection, user_token, limit=0, offset=0, timestamp
             "entity_token": item["entity_token"]
         }
 
+        if cursor is not None:
+            result["cursor"] = _encode_cursor(item["created"], item["id"])
+
+        yield result
 
-async def get_comment_replies(connection, comment_token, limit=0, offset=0):
+
+async def get_comment_replies(connection, comment_token, limit=0, offset=0, cursor=None, depth=None):
     comment = await db_api.get_comment_by_key(connection, comment_token)
     if not comment:
         raise APIException("Comment '{}' not found".format(comment_token))
 
-    async for item in db_api.get_comment_replies(connection, comment["id"], limit, offset):
-        yield {
+    async for item in db_api.get_comment_replies(connection, comment, limit, offset, _decode_path_cursor(cursor),
+                                                 depth):
+        result = {
             "text": item["text"],
             "created": str(item["created"]),
             "updated": str(item["updated"]),
@@ -133,3 +365,8 @@ async def get_comment_replies(connection, comment_token, limit=0, offset=0):
             "parent_key": item["parent_key"],
             "user_token": item["user"]
         }
+
+        if cursor is not None:
+            result["cursor"] = _encode_path_cursor(item["path"])
+
+        yield result
@@ -1,21 +1,27 @@
+import json
 import os
 
 from aiohttp import web
-from sqlalchemy import create_engine
-from sqlalchemy_aio import ASYNCIO_STRATEGY
 
 import api
+import db_api
+import response_streamer
 from arg_schemas import reply_entity_validator, reply_comment_validator, edit_comment_validator, \
-    remove_comment_validator, read_entity_comments_validator, validate_args, ValidatorException, \
+    reply_batch_validator, remove_comment_validator, read_entity_comments_validator, validate_args, ValidatorException, \
     read_user_comments_validator, read_comment_replies_validator, read_entity_replies_validator, \
+    read_entity_count_validator, read_user_count_validator, read_batch_validator, read_comment_history_validator, \
     stream_user_comments_validator, stream_entity_replies_validator
-from response_streamer import XMLStreamer
+from cache import SingleFlight
+from db_pool import create_router
+from response_streamer import XMLStreamer, JSONStreamer, NDJSONStreamer, CSVStreamer
 from utils import parse_datetime
 
 
-async def _read_args(request):
+async def _read_args(request, validator):
     post_data = (await request.json()) if request.method == "POST" else {}
-    get_data = dict(request.match_info)
+    # Query parameters the handler does not declare (cache busters and the like) are not its arguments
+    query_data = {key: value for key, value in request.query.items() if key in validator.schema}
+    get_data = {**query_data, **request.match_info}
 
     return {**get_data, **post_data}
 
@@ -43,6 +49,15 @@ async def reply_comment(connection, data):
     return {"comment_token": comment_token}
 
 
+async def reply_batch(connection, data):
+    comment_tokens = await api.add_comments(
+        connection,
+        comments=data["comments"]
+    )
+
+    return {"comment_tokens": comment_tokens}
+
+
 async def edit_comment(connection, data):
     revision_key = await api.edit_comment(
         connection,
@@ -67,70 +82,270 @@ async def remove_comment(connection, data):
         return {"success": False}
 
 
-async def read_entity_comments(connection, data):
-    return [
-        item async for item in api.get_entity_comments(
-            connection,
-            entity_type=data["type"],
-            entity_token=data["entity"],
-            limit=int(data.get("limit", "1000")),
-            offset=int(data.get("offset", "0")),
-            with_replies=False
-        )
-    ]
+async def read_entity_comments(connection, data, version=None):
+    return await api.get_entity_comments_page(
+        connection,
+        entity_type=data["type"],
+        entity_token=data["entity"],
+        limit=int(data.get("limit", "1000")),
+        offset=0 if "cursor" in data else int(data.get("offset", "0")),
+        with_replies=False,
+        cursor=data.get("cursor"),
+        version=version
+    )
 
 
-async def read_entity_replies(connection, data):
-    return [
-        item async for item in api.get_entity_comments(
-            connection,
-            entity_type=data["type"],
-            entity_token=data["entity"],
-            limit=int(data.get("limit", "1000")),
-            offset=int(data.get("offset", "0")),
-            with_replies=True
-        )
-    ]
+async def read_entity_replies(connection, data, version=None):
+    return await api.get_entity_comments_page(
+        connection,
+        entity_type=data["type"],
+        entity_token=data["entity"],
+        limit=int(data.get("limit", "1000")),
+        offset=0 if "cursor" in data else int(data.get("offset", "0")),
+        with_replies=True,
+        cursor=data.get("cursor"),
+        version=version
+    )
 
 
 async def read_user_comments(connection, data):
-    return [
-        item async for item in api.get_user_comments(
+    async for item in api.get_user_comments(
             connection,
-            user_token=data["user_token"]
-        )
-    ]
+            user_token=data["user_token"],
+            limit=int(data.get("limit", "0")),
+            cursor=data.get("cursor"),
+            stream=True
+    ):
+        yield item
+
+
+async def read_entity_count(connection, data):
+    return await api.get_entity_counters(
+        connection,
+        entity_type=data["type"],
+        entity_token=data["entity"]
+    )
+
+
+async def read_user_count(connection, data):
+    return await api.get_user_counters(
+        connection,
+        user_token=data["user_token"]
+    )
+
+
+async def read_comment_history(connection, data):
+    return await api.get_comment_history(
+        connection,
+        comment_token=data["comment_token"]
+    )
+
+
+async def read_batch(connection, data):
+    return await api.get_entities_first_page(
+        connection,
+        entities=data["entities"],
+        limit=data.get("limit", 10)
+    )
 
 
 async def read_comment_replies(connection, data):
-    return [
-        item async for item in api.get_comment_replies(
+    async for item in api.get_comment_replies(
             connection,
-            comment_token=data["comment_token"]
-        )
-    ]
+            comment_token=data["comment_token"],
+            limit=int(data.get("limit", "0")),
+            cursor=data.get("cursor"),
+            depth=int(data["depth"]) if "depth" in data else None
+    ):
+        yield item
 
 
 arg_validators = {
     reply_entity: reply_entity_validator,
     reply_comment: reply_comment_validator,
+    reply_batch: reply_batch_validator,
     edit_comment: edit_comment_validator,
     remove_comment: remove_comment_validator,
     read_entity_comments: read_entity_comments_validator,
     read_user_comments: read_user_comments_validator,
     read_comment_replies: read_comment_replies_validator,
-    read_entity_replies: read_entity_replies_validator
+    read_entity_replies: read_entity_replies_validator,
+    read_entity_count: read_entity_count_validator,
+    read_user_count: read_user_count_validator,
+    read_batch: read_batch_validator,
+    read_comment_history: read_comment_history_validator
+}
+
+
+write_handlers = {reply_entity, reply_comment, reply_batch, edit_comment, remove_comment}
+
+# These handlers yield items, which are written to the response as they are read
+stream_handlers = {read_user_comments, read_comment_replies}
+
+# Results of these handlers are lists, which are written to the response item by item
+list_handlers = {read_entity_comments, read_entity_replies}
+
+
+async def _entity_etag(connection, data):
+    return await api.get_entity_etag(connection, data["type"], data["entity"])
+
+
+async def _comment_etag(connection, data):
+    return await api.get_comment_etag(connection, data["comment_token"])
+
+
+# Results of these handlers change only with the entity's version: they are answered with an ETag read by
+# the mapped function. List handlers take the version, so that a cached page is never older than the ETag sent with it
+etag_handlers = {
+    read_entity_comments: _entity_etag,
+    read_entity_replies: _entity_etag,
+    read_comment_replies: _comment_etag
 }
 
 
-async def handle_request(connection, request, future):
+def _user_tokens(data):
+    if "comments" in data:
+        return {item["user_token"] for item in data["comments"]}
+    elif "user_token" in data:
+        return {data["user_token"]}
+    else:
+        return set()
+
+
+def _select_pool(db_router, data, future):
+    if future in write_handlers:
+        return db_router.write_pool(_user_tokens(data))
+    else:
+        return db_router.read_pool(_user_tokens(data))
+
+
+def _etag_matches(request, etag):
+    if_none_match = request.headers.get("If-None-Match", None)
+    if not if_none_match:
+        return False
+
+    # Weak comparison: the body is the same for the same version, whatever its encoding
+    tags = {tag.strip() for tag in if_none_match.split(",")}
+    return "*" in tags or etag in tags or "W/" + etag in tags
+
+
+NOT_MODIFIED = object()
+
+# Streamer factory, content type and charset of a streamed response
+JSON_RESULT_FORMAT = (lambda response: JSONStreamer(response, "result"), "application/json", "utf-8")
+
+# Identical reads in flight at the same time run once, see `handle_request`
+read_flights = SingleFlight()
+
+
+class _ResponseInterrupted(Exception):
+    # Raised once the status is sent: the error can only be reported by dropping the connection
+    pass
+
+
+async def _write_stream(request, streamer_format, items, more_items=None, headers=None):
+    # `items` followed by the async iterable `more_items`, written as they come in the format of `streamer_format`
+    create_streamer, content_type, charset = streamer_format
+
+    response = web.StreamResponse(headers=headers)
+    response.content_type = content_type
+    if charset is not None:
+        response.charset = charset
+
+    await response.prepare(request)
+
+    try:
+        streamer = create_streamer(response)
+        await streamer.write_head()
+        for item in items:
+            await streamer.write_body(item)
+        if more_items is not None:
+            async for item in more_items:
+                await streamer.write_body(item)
+        await streamer.write_tail()
+    except Exception as e:
+        raise _ResponseInterrupted() from e
+
+    return response
+
+
+async def _stream_items(db_router, request, data, future, streamer_format, headers=None):
+    async with _select_pool(db_router, data, future).acquire() as connection:
+        if future in etag_handlers:
+            etag = await etag_handlers[future](connection, data)
+
+            if _etag_matches(request, etag):
+                return web.Response(status=304, headers={"ETag": etag})
+
+            headers = {**(headers or {}), "ETag": etag}
+
+        items = future(connection, data)
+
+        try:
+            # The first item is read before the status is sent, so that "not found" is still an error response
+            try:
+                first_items = [await items.__anext__()]
+            except StopAsyncIteration:
+                first_items = []
+
+            return await _write_stream(request, streamer_format, first_items, items, headers)
+        finally:
+            # Closed before the connection goes back to the pool, also when the items were not read to the end
+            await items.aclose()
+
+
+async def _execute(db_router, request, data, future):
+    etag = None
+    async with _select_pool(db_router, data, future).acquire() as connection:
+        if future in etag_handlers:
+            etag = await etag_handlers[future](connection, data)
+
+            if _etag_matches(request, etag):
+                return etag, NOT_MODIFIED
+
+            result = await future(connection, data, version=etag)
+        else:
+            result = await future(connection, data)
+
+    return etag, result
+
+
+async def handle_request(db_router, request, future):
     try:
-        data = await _read_args(request)
+        data = await _read_args(request, arg_validators[future])
 
         validate_args(data, arg_validators[future])
 
-        result = await future(connection, data)
-        return web.json_response({"result": result})
+        if future in stream_handlers:
+            return await _stream_items(db_router, request, data, future, JSON_RESULT_FORMAT)
+
+        if future in write_handlers:
+            etag, result = await _execute(db_router, request, data, future)
+        else:
+            # Waiters share the result, so everything it depends on is in the key;
+            # a single connection is held for all of them
+            key = (
+                future.__name__,
+                json.dumps(data, sort_keys=True),
+                request.headers.get("If-None-Match", None) if future in etag_handlers else None
+            )
+            etag, result = await read_flights.do(key, lambda: _execute(db_router, request, data, future))
+
+        if result is NOT_MODIFIED:
+            return web.Response(status=304, headers={"ETag": etag})
+
+        if future in list_handlers:
+            return await _write_stream(
+                request, JSON_RESULT_FORMAT, result, headers={"ETag": etag} if etag is not None else None
+            )
+
+        response = web.json_response({"result": result})
+        if etag is not None:
+            response.headers["ETag"] = etag
+
+        return response
+    except _ResponseInterrupted:
+        raise
     except TimeoutError:
         return web.json_response({"result": "error", "reasons": "Request timeout expired"}, status=500)
     except api.APIException as e:
@@ -142,19 +357,17 @@ async def handle_request(connection, request, future):
 
 
 async def stream_user_comments(connection, data):
-    idx = 1
     async for item in api.get_user_comments(
             connection,
             user_token=data["user_token"],
             timestamp_from=parse_datetime(data.get("timestamp_from", None)),
-            timestamp_to=parse_datetime(data.get("timestamp_to", None))
+            timestamp_to=parse_datetime(data.get("timestamp_to", None)),
+            stream=True
     ):
-        yield {"record{}".format(idx): item}
-        idx += 1
+        yield item
 
 
 async def stream_entity_replies(connection, data):
-    idx = 1
     async for item in api.get_entity_comments(
             connection,
             entity_type=data["type"],
@@ -163,10 +376,10 @@ async def stream_entity_replies(connection, data):
             offset=0,
             timestamp_from=parse_datetime(data.get("timestamp_from", None)),
             timestamp_to=parse_datetime(data.get("timestamp_to", None)),
-            with_replies=True
+            with_replies=True,
+            stream=True
     ):
-        yield {"record{}".format(idx): item}
-        idx += 1
+        yield item
 
 
 streamer_arg_validators = {
@@ -175,72 +388,175 @@ streamer_arg_validators = {
 }
 
 
-async def handle_stream(connection, request, future):
-    response = web.StreamResponse(
-        status=200,
-        reason="OK",
-        headers={"Content-Type": "application/octet-stream"}
-    )
+download_formats = {
+    "xml": (lambda response: XMLStreamer(response, record_tag="record"), "application/octet-stream", None),
+    "json": (JSONStreamer, "application/json", "utf-8"),
+    "ndjson": (NDJSONStreamer, "application/x-ndjson", "utf-8"),
+    "csv": (CSVStreamer, "text/csv", "utf-8")
+}
 
-    streamer = XMLStreamer(response)
+# Media types of the Accept header; XML stays the format of clients which accept anything
+accept_formats = {
+    "*/*": "xml",
+    "application/octet-stream": "xml",
+    "application/xml": "xml",
+    "text/xml": "xml",
+    "application/json": "json",
+    "application/x-ndjson": "ndjson",
+    "application/ndjson": "ndjson",
+    "text/csv": "csv"
+}
 
-    await response.prepare(request)
 
+def _download_format(request, data):
+    # `?format=` wins over the Accept header; `None` when the header accepts none of the formats
+    if "format" in data:
+        return data["format"]
+
+    accept = request.headers.get("Accept", None)
+    if not accept:
+        return "xml"
+
+    candidates = []
+    for position, media_range in enumerate(accept.split(",")):
+        media_type, *params = [part.strip() for part in media_range.split(";")]
+
+        quality = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+
+        media_type = media_type.lower()
+        if media_type.endswith("/*") and media_type != "*/*":
+            # A range of a type takes the first format of the table with that type
+            media_type = next(
+                (known_type for known_type in accept_formats if known_type.startswith(media_type[:-1])), None
+            )
+
+        if quality > 0 and media_type in accept_formats:
+            candidates.append((quality, -position, accept_formats[media_type]))
+
+    return max(candidates)[2] if candidates else None
+
+
+async def handle_stream(db_router, request, future):
     try:
-        data = await _read_args(request)
+        data = await _read_args(request, streamer_arg_validators[future])
 
         validate_args(data, streamer_arg_validators[future])
 
-        await streamer.write_head()
-        async for item in future(connection, data):
-            await streamer.write_body(item)
-        await streamer.write_tail()
+        download_format = _download_format(request, data)
+        if download_format is None:
+            return web.json_response({
+                "result": "error",
+                "reason": "Not acceptable, available formats: {}".format(", ".join(download_formats))
+            }, status=406)
+
+        return await _stream_items(
+            db_router, request, data, future, download_formats[download_format], headers={"Vary": "Accept"}
+        )
+    except _ResponseInterrupted:
+        raise
+    except TimeoutError:
+        return web.json_response({"result": "error", "reasons": "Request timeout expired"}, status=500)
     except api.APIException as e:
-        response.write_eof("Error: {}".format(str(e)).encode("utf-8"))
+        return web.json_response({"result": "error", "reason": "API error ({})".format(str(e))}, status=500)
+    except ValidatorException as e:
+        return web.json_response({"result": "error", "error": str(e)}, status=500)
+    except Exception as e:
+        return web.json_response({"error": "Internal server error ({})".format(str(e))}, status=500)
 
-    return response
+
+async def handle_stats(request):
+    return web.json_response({"result": {
+        "id_cache": db_api.id_cache.stats(),
+        "response_cache": api.response_cache.stats(),
+        "read_flights": read_flights.stats()
+    }})
 
 
 async def get_app():
-    db_engine = create_engine(os.getenv("DATABASE_URL"), strategy=ASYNCIO_STRATEGY)
-    db_connection = await db_engine.connect()
+    db_router = create_router(os.getenv("DATABASE_URL"), os.getenv("DATABASE_READ_URL"), os.environ)
+    await db_router.warm_up()
+
+    db_api.id_cache.configure(
+        size=int(os.getenv("ID_CACHE_SIZE", "10000")),
+        ttl=float(os.getenv("ID_CACHE_TTL", "3600")),
+        negative_ttl=float(os.getenv("ID_CACHE_NEGATIVE_TTL", "5"))
+    )
+    api.response_cache.configure(
+        size=int(os.getenv("RESPONSE_CACHE_SIZE", "1000")),
+        ttl=float(os.getenv("RESPONSE_CACHE_TTL", "5")),
+        negative_ttl=0
+    )
+    db_api.stream_batch_size = int(os.getenv("DATABASE_STREAM_BATCH_SIZE", "1000"))
+    response_streamer.default_chunk_size = int(os.getenv("RESPONSE_CHUNK_SIZE", "65536"))
+    db_api.delta_revisions = os.getenv("COMMENT_TEXT_DELTA", "0") == "1"
 
     app = web.Application()
+    app["db_router"] = db_router
+    app["db_pool"] = db_router.primary
+
     app.router.add_post(
         "/api/reply/{type}/{entity}",
-        lambda request: handle_request(db_connection, request, reply_entity)
+        lambda request: handle_request(db_router, request, reply_entity)
+    )
+    app.router.add_post(
+        "/api/batch/reply",
+        lambda request: handle_request(db_router, request, reply_batch)
     )
     app.router.add_post(
         "/api/reply/{comment_token}",
-        lambda request: handle_request(db_connection, request, reply_comment)
+        lambda request: handle_request(db_router, request, reply_comment)
     )
     app.router.add_post(
         "/api/edit/{comment_token}/{user_token}",
-        lambda request: handle_request(db_connection, request, edit_comment)
+        lambda request: handle_request(db_router, request, edit_comment)
     )
     app.router.add_post(
         "/api/remove/{comment_token}",
-        lambda request: handle_request(db_connection, request, remove_comment)
+        lambda request: handle_request(db_router, request, remove_comment)
     )
 
     for url in ["/api/comments/{type}/{entity}",
                 "/api/comments/{type}/{entity}/{limit}",
                 "/api/comments/{type}/{entity}/{offset}/{limit}"]:
         app.router.add_get(
-            url, lambda request: handle_request(db_connection, request, read_entity_comments)
+            url, lambda request: handle_request(db_router, request, read_entity_comments)
         )
 
     app.router.add_get(
         "/api/comments/{user_token}",
-        lambda request: handle_request(db_connection, request, read_user_comments)
+        lambda request: handle_request(db_router, request, read_user_comments)
     )
     app.router.add_get(
         "/api/replies/{comment_token}",
-        lambda request: handle_request(db_connection, request, read_comment_replies)
+        lambda request: handle_request(db_router, request, read_comment_replies)
     )
     app.router.add_get(
         "/api/replies/{type}/{entity}",
-        lambda request: handle_request(db_connection, request, read_entity_replies)
+        lambda request: handle_request(db_router, request, read_entity_replies)
+    )
+
+    app.router.add_get(
+        "/api/history/{comment_token}",
+        lambda request: handle_request(db_router, request, read_comment_history)
+    )
+    app.router.add_post(
+        "/api/batch/comments",
+        lambda request: handle_request(db_router, request, read_batch)
+    )
+    app.router.add_get(
+        "/api/count/{type}/{entity}",
+        lambda request: handle_request(db_router, request, read_entity_count)
+    )
+    app.router.add_get(
+        "/api/user/count/{user_token}",
+        lambda request: handle_request(db_router, request, read_user_count)
     )
 
     for url in ["/api/user/download/{user_token}",
@@ -248,7 +564,7 @@ async def get_app():
                 "/api/user/download/{user_token}/{timestamp_from}/{timestamp_to}"]:
         app.router.add_get(
             url,
-            lambda request: handle_stream(db_connection, request, stream_user_comments)
+            lambda request: handle_stream(db_router, request, stream_user_comments)
         )
 
     for url in ["/api/download/{type}/{entity}",
@@ -256,9 +572,11 @@ async def get_app():
                 "/api/download/{type}/{entity}/{timestamp_from}/{timestamp_to}"]:
         app.router.add_get(
             url,
-            lambda request: handle_stream(db_connection, request, stream_entity_replies)
+            lambda request: handle_stream(db_router, request, stream_entity_replies)
         )
 
+    app.router.add_get("/api/stats", handle_stats)
+
     return app
 
 
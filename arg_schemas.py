@@ -1,76 +1,278 @@
-from cerberus import Validator
+from collections.abc import Mapping, Sequence
 
 
 class ValidatorException(Exception):
     pass
 
 
+class SchemaException(Exception):
+    pass
+
+
+_type_checks = {
+    "string": lambda value: isinstance(value, str),
+    "integer": lambda value: isinstance(value, int),
+    "dict": lambda value: isinstance(value, Mapping),
+    "list": lambda value: isinstance(value, Sequence) and not isinstance(value, str)
+}
+
+_NULL_ERROR = ["null value not allowed"]
+_REQUIRED_ERROR = ["required field"]
+_UNKNOWN_ERROR = ["unknown field"]
+
+
+def _compile_allowed(rules):
+    if rules["type"] in ("dict", "list"):
+        raise SchemaException("Rule 'allowed' is not supported for type '{}'".format(rules["type"]))
+
+    allowed = set(rules["allowed"])
+
+    def check_allowed(value):
+        return [] if value in allowed else ["unallowed value {}".format(value)]
+
+    return check_allowed
+
+
+def _compile_max(rules):
+    if rules["type"] != "integer":
+        raise SchemaException("Rule 'max' is not supported for type '{}'".format(rules["type"]))
+
+    maximum = rules["max"]
+    max_error = ["max value is {}".format(maximum)]
+
+    def check_max(value):
+        return max_error if value > maximum else []
+
+    return check_max
+
+
+def _compile_maxlength(rules):
+    if rules["type"] not in ("list", "string"):
+        raise SchemaException("Rule 'maxlength' is not supported for type '{}'".format(rules["type"]))
+
+    maximum = rules["maxlength"]
+    maxlength_error = ["max length is {}".format(maximum)]
+
+    def check_maxlength(value):
+        return maxlength_error if len(value) > maximum else []
+
+    return check_maxlength
+
+
+def _compile_min(rules):
+    if rules["type"] != "integer":
+        raise SchemaException("Rule 'min' is not supported for type '{}'".format(rules["type"]))
+
+    minimum = rules["min"]
+    min_error = ["min value is {}".format(minimum)]
+
+    def check_min(value):
+        return min_error if value < minimum else []
+
+    return check_min
+
+
+def _compile_schema(rules):
+    if rules["type"] == "list":
+        check_item = _compile_rules(rules["schema"])
+
+        def check_items(value):
+            errors = {}
+            for idx, item in enumerate(value):
+                item_errors = check_item(item)
+                if item_errors:
+                    errors[idx] = item_errors
+
+            return [errors] if errors else []
+
+        return check_items
+    elif rules["type"] == "dict":
+        check_document = compile_validator(rules["schema"])
+
+        def check_document_value(value):
+            errors = check_document(value)
+            return [errors] if errors else []
+
+        return check_document_value
+    else:
+        raise SchemaException("Rule 'schema' is not supported for type '{}'".format(rules["type"]))
+
+
+# Cerberus reports the errors of a field in the order of its rule names, so do these
+_rule_compilers = {
+    "allowed": _compile_allowed,
+    "max": _compile_max,
+    "maxlength": _compile_maxlength,
+    "min": _compile_min,
+    "schema": _compile_schema
+}
+
+
+def _compile_rules(rules):
+    # Check of a single value: the list of its errors, empty when the value is valid.
+    # A null value or a value of another type fails only that check, every other rule is applied and reported
+    # the way Cerberus does, so messages stay the same
+    unsupported = set(rules) - set(_rule_compilers) - {"type", "required"}
+    if unsupported:
+        raise SchemaException("Unsupported rules {}".format(sorted(unsupported)))
+
+    if rules.get("type", None) not in _type_checks:
+        raise SchemaException("Unsupported type {!r}".format(rules.get("type", None)))
+
+    type_check = _type_checks[rules["type"]]
+    type_error = ["must be of {} type".format(rules["type"])]
+    rule_checks = [compile_rule(rules) for rule, compile_rule in sorted(_rule_compilers.items()) if rule in rules]
+
+    def check(value):
+        if value is None:
+            return _NULL_ERROR
+        if not type_check(value):
+            return type_error
+
+        errors = []
+        for rule_check in rule_checks:
+            errors.extend(rule_check(value))
+
+        return errors
+
+    return check
+
+
+def compile_validator(schema):
+    # The schema is a Cerberus one (types "string", "integer", "dict", "list"; rules "required", "allowed", "min",
+    # "max", "maxlength", "schema"), any other rule raises `SchemaException`
+    # compiled once into a stateless check returning the errors of a document the way `Validator.errors` does;
+    # unknown fields are not allowed
+    checks = {field: _compile_rules(rules) for field, rules in schema.items()}
+    required = [field for field, rules in schema.items() if rules.get("required", False)]
+
+    def check(document):
+        errors = {}
+
+        for field, value in document.items():
+            check_field = checks.get(field, None)
+            if check_field is None:
+                errors[field] = _UNKNOWN_ERROR
+            else:
+                field_errors = check_field(value)
+                if field_errors:
+                    errors[field] = field_errors
+
+        for field in required:
+            if field not in document:
+                errors[field] = _REQUIRED_ERROR
+
+        return dict(sorted(errors.items())) if errors else errors
+
+    check.schema = schema
+
+    return check
+
+
 def validate_args(data, validator):
-    if not validator.validate(data):
+    errors = validator(data)
+    if errors:
         raise ValidatorException(
-            "Invalid arguments ({})".format(validator.errors)
+            "Invalid arguments ({})".format(errors)
         )
 
 
-reply_entity_validator = Validator(
-    allow_unknown=False,
-    schema={
-        "type": {"type": "string", "required": True},
-        "entity": {"type": "string", "required": True},
-        "user_token": {"type": "string", "required": True},
-        "text": {"type": "string", "required": True}
-    })
-reply_comment_validator = Validator(
-    allow_unknown=False,
-    schema={
-        "comment_token": {"type": "string", "required": True},
-        "user_token": {"type": "string", "required": True},
-        "text": {"type": "string", "required": True}
-    })
-edit_comment_validator = Validator(
-    allow_unknown=False,
-    schema={
-        "user_token": {"type": "string", "required": True},
-        "comment_token": {"type": "string", "required": True},
-        "text": {"type": "string", "required": True}
-    })
-remove_comment_validator = Validator(
-    allow_unknown=False,
-    schema={
-        "user_token": {"type": "string", "required": True},
-        "comment_token": {"type": "string", "required": True}
-    })
-read_entity_comments_validator = Validator(
-    allow_unknown=False,
-    schema={
-        "type": {"type": "string", "required": True},
-        "entity": {"type": "string", "required": True},
-        "limit": {"type": "string", "required": False},
-        "offset": {"type": "string", "required": False}
-    })
+reply_entity_validator = compile_validator({
+    "type": {"type": "string", "required": True},
+    "entity": {"type": "string", "required": True},
+    "user_token": {"type": "string", "required": True},
+    "text": {"type": "string", "required": True}
+})
+reply_comment_validator = compile_validator({
+    "comment_token": {"type": "string", "required": True},
+    "user_token": {"type": "string", "required": True},
+    "text": {"type": "string", "required": True}
+})
+reply_batch_validator = compile_validator({
+    "comments": {
+        "type": "list",
+        "required": True,
+        "schema": {
+            "type": "dict",
+            "schema": {
+                "type": {"type": "string", "required": False},
+                "entity": {"type": "string", "required": False},
+                "comment_token": {"type": "string", "required": False},
+                "user_token": {"type": "string", "required": True},
+                "text": {"type": "string", "required": True}
+            }
+        }
+    }
+})
+edit_comment_validator = compile_validator({
+    "user_token": {"type": "string", "required": True},
+    "comment_token": {"type": "string", "required": True},
+    "text": {"type": "string", "required": True}
+})
+remove_comment_validator = compile_validator({
+    "user_token": {"type": "string", "required": True},
+    "comment_token": {"type": "string", "required": True}
+})
+read_entity_comments_validator = compile_validator({
+    "type": {"type": "string", "required": True},
+    "entity": {"type": "string", "required": True},
+    "limit": {"type": "string", "required": False},
+    "offset": {"type": "string", "required": False},
+    "cursor": {"type": "string", "required": False},
+    "user_token": {"type": "string", "required": False}
+})
 read_entity_replies_validator = read_entity_comments_validator
-read_user_comments_validator = Validator(
-    allow_unknown=False,
-    schema={
-        "user_token": {"type": "string", "required": True}
-    })
-read_comment_replies_validator = Validator(
-    allow_unknown=False,
-    schema={
-        "comment_token": {"type": "string", "required": True}
-    })
-stream_user_comments_validator = Validator(
-    allow_unknown=False,
-    schema={
-        "user_token": {"type": "string", "required": True},
-        "timestamp_from": {"type": "string", "required": False},
-        "timestamp_to": {"type": "string", "required": False}
-    })
-stream_entity_replies_validator = Validator(
-    allow_unknown=False,
-    schema={
-        "type": {"type": "string", "required": True},
-        "entity": {"type": "string", "required": True},
-        "timestamp_from": {"type": "string", "required": False},
-        "timestamp_to": {"type": "string", "required": False}
-    })
+read_entity_count_validator = compile_validator({
+    "type": {"type": "string", "required": True},
+    "entity": {"type": "string", "required": True},
+    "user_token": {"type": "string", "required": False}
+})
+read_batch_validator = compile_validator({
+    "entities": {
+        "type": "list",
+        "required": True,
+        "maxlength": 100,
+        "schema": {
+            "type": "dict",
+            "schema": {
+                "type": {"type": "string", "required": True},
+                "entity": {"type": "string", "required": True}
+            }
+        }
+    },
+    "limit": {"type": "integer", "required": False, "min": 1, "max": 100},
+    "user_token": {"type": "string", "required": False}
+})
+read_user_comments_validator = compile_validator({
+    "user_token": {"type": "string", "required": True},
+    "limit": {"type": "string", "required": False},
+    "cursor": {"type": "string", "required": False}
+})
+read_user_count_validator = compile_validator({
+    "user_token": {"type": "string", "required": True}
+})
+read_comment_replies_validator = compile_validator({
+    "comment_token": {"type": "string", "required": True},
+    "limit": {"type": "string", "required": False},
+    "cursor": {"type": "string", "required": False},
+    "depth": {"type": "string", "required": False},
+    "user_token": {"type": "string", "required": False}
+})
+read_comment_history_validator = compile_validator({
+    "comment_token": {"type": "string", "required": True},
+    "user_token": {"type": "string", "required": False}
+})
+stream_user_comments_validator = compile_validator({
+    "user_token": {"type": "string", "required": True},
+    "timestamp_from": {"type": "string", "required": False},
+    "timestamp_to": {"type": "string", "required": False},
+    "format": {"type": "string", "required": False, "allowed": ["xml", "json", "ndjson", "csv"]}
+})
+stream_entity_replies_validator = compile_validator({
+    "type": {"type": "string", "required": True},
+    "entity": {"type": "string", "required": True},
+    "timestamp_from": {"type": "string", "required": False},
+    "timestamp_to": {"type": "string", "required": False},
+    "user_token": {"type": "string", "required": False},
+    "format": {"type": "string", "required": False, "allowed": ["xml", "json", "ndjson", "csv"]}
+})
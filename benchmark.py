@@ -0,0 +1,196 @@
+import argparse
+import asyncio
+import random
+import string
+import timeit
+
+from sqlalchemy.dialects import postgresql
+
+import arg_schemas
+import db_api
+import delta
+import response_streamer
+
+try:
+    from cerberus import Validator
+except ImportError:
+    Validator = None
+
+
+def _report(name, seconds, number):
+    print("{:<32} {:>10.1f} us/call".format(name, seconds / number * 1000000))
+
+
+def bench_statements(args):
+    dialect = postgresql.dialect()
+    # Page of top level comments inside a time window, the heaviest listing variant
+    flags = (False, True, True, False, True, True)
+
+    def rebuild():
+        return db_api._entity_comments_query(*flags).compile(dialect=dialect)
+
+    compiled_cache = {}
+
+    def reuse():
+        query = db_api._statement(db_api._entity_comments_query, *flags)
+
+        compiled = compiled_cache.get(query, None)
+        if compiled is None:
+            compiled = compiled_cache[query] = query.compile(dialect=dialect)
+
+        return compiled
+
+    _report("build and compile per call", timeit.timeit(rebuild, number=args.number), args.number)
+    _report("prebuilt, compiled once", timeit.timeit(reuse, number=args.number), args.number)
+
+
+def _edit(text, rnd):
+    # Small in-place change of a long text: a typo fix or an inserted sentence
+    position = rnd.randrange(len(text))
+    insertion = "".join(rnd.choice(string.ascii_letters + " ") for _ in range(rnd.randint(1, 40)))
+
+    return text[:position] + insertion + text[position + rnd.randint(0, 20):]
+
+
+def bench_revisions(args):
+    rnd = random.Random(args.seed)
+
+    full_size = delta_size = 0
+    chains = []
+    for _ in range(args.comments):
+        texts = ["".join(rnd.choice(string.ascii_letters + " ") for _ in range(args.length))]
+        for _ in range(args.edits):
+            texts.append(_edit(texts[-1], rnd))
+
+        stored = [(texts[-1], False)]
+        for successor, text in zip(reversed(texts), reversed(texts[:-1])):
+            data = delta.compress(successor, text)
+            stored.append((text, False) if data is None else (data, True))
+
+        full_size += sum(len(text.encode("utf-8")) for text in texts)
+        delta_size += sum(len(data.encode("utf-8")) for data, _ in stored)
+        chains.append(stored)
+
+    def rebuild():
+        for stored in chains:
+            text = None
+            for data, is_delta in stored:
+                text = delta.decode(text, data) if is_delta else data
+
+    print("{} comments x {} chars, {} edits each".format(args.comments, args.length, args.edits))
+    print("{:<32} {:>10} bytes".format("full revisions", full_size))
+    print("{:<32} {:>10} bytes ({:.1f}%)".format("delta revisions", delta_size, delta_size * 100.0 / full_size))
+    _report("full history reconstruction", timeit.timeit(rebuild, number=1), len(chains))
+
+
+def bench_validation(args):
+    cases = [
+        ("reply", arg_schemas.reply_entity_validator, {
+            "type": "video", "entity": "entity1", "user_token": "user1", "text": "Nice video!"
+        }),
+        ("batch read", arg_schemas.read_batch_validator, {
+            "entities": [{"type": "video", "entity": "entity{}".format(idx)} for idx in range(args.entities)],
+            "limit": 10
+        }),
+        ("invalid reply", arg_schemas.reply_entity_validator, {
+            "type": "video", "entity": 1, "text": None, "unknown": "value"
+        })
+    ]
+
+    if Validator is None:
+        print("Cerberus is not installed, only compiled validators are measured")
+
+    for name, check, document in cases:
+        _report("compiled, " + name, timeit.timeit(lambda: check(document), number=args.number), args.number)
+
+        if Validator is not None:
+            validator = Validator(check.schema, allow_unknown=False)
+            _report("cerberus, " + name, timeit.timeit(lambda: validator.validate(document), number=args.number),
+                    args.number)
+
+
+class _Sink(object):
+    # Stands for the HTTP response: counts written bytes and writes
+    def __init__(self):
+        self.size = 0
+        self.writes = 0
+
+    async def write(self, data):
+        self.size += len(data)
+        self.writes += 1
+
+    async def write_eof(self, data=b""):
+        await self.write(data)
+
+
+def bench_xml(args):
+    rnd = random.Random(args.seed)
+
+    # A download of entity comments as `api.get_entity_comments` formats them, with some markup in the texts
+    texts = [
+        "".join(rnd.choice(string.ascii_letters + " " * 8 + "<>&\"'") for _ in range(rnd.randint(20, args.length)))
+        for _ in range(1000)
+    ]
+    records = [{
+        "text": texts[idx % len(texts)],
+        "created": "2018-04-01 12:00:00.{:06d}".format(idx % 1000000),
+        "updated": "2018-04-01 12:00:00.{:06d}".format(idx % 1000000),
+        "user": "user{}".format(idx % 5000),
+        "key": "6f1f3c2e-9a4b-4c53-8f0e-{:012d}".format(idx),
+        "parent_key": None
+    } for idx in range(args.records)]
+
+    async def export(chunk_size):
+        sink = _Sink()
+        streamer = response_streamer.XMLStreamer(sink, record_tag="record", chunk_size=chunk_size)
+
+        await streamer.write_head()
+        for record in records:
+            await streamer.write_body(record)
+        await streamer.write_tail()
+
+        return sink
+
+    print("{} records".format(args.records))
+    for name, chunk_size in [("write per record", 1), ("buffered, {} bytes".format(args.chunk_size), args.chunk_size)]:
+        started = timeit.default_timer()
+        sink = asyncio.get_event_loop().run_until_complete(export(chunk_size))
+        seconds = timeit.default_timer() - started
+
+        print("{:<32} {:>10.1f} MB/s, {} writes".format(name, sink.size / seconds / 1000000, sink.writes))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Macaque micro-benchmarks")
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.required = True
+
+    statements_parser = subparsers.add_parser("statements", help="Listing statement preparation CPU per call")
+    statements_parser.add_argument("--number", type=int, default=10000)
+    statements_parser.set_defaults(func=bench_statements)
+
+    revisions_parser = subparsers.add_parser("revisions", help="Storage size of full and delta revisions")
+    revisions_parser.add_argument("--comments", type=int, default=200)
+    revisions_parser.add_argument("--length", type=int, default=2000)
+    revisions_parser.add_argument("--edits", type=int, default=20)
+    revisions_parser.add_argument("--seed", type=int, default=0)
+    revisions_parser.set_defaults(func=bench_revisions)
+
+    validation_parser = subparsers.add_parser("validation", help="Request argument validation CPU per call")
+    validation_parser.add_argument("--number", type=int, default=10000)
+    validation_parser.add_argument("--entities", type=int, default=10)
+    validation_parser.set_defaults(func=bench_validation)
+
+    xml_parser = subparsers.add_parser("xml", help="XML download encoding throughput")
+    xml_parser.add_argument("--records", type=int, default=1000000)
+    xml_parser.add_argument("--length", type=int, default=300)
+    xml_parser.add_argument("--chunk-size", type=int, default=response_streamer.default_chunk_size)
+    xml_parser.add_argument("--seed", type=int, default=0)
+    xml_parser.set_defaults(func=bench_xml)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,156 @@
+import asyncio
+import time
+from collections import OrderedDict
+
+MISSING = object()
+
+
+class LRUCache(object):
+    def __init__(self, size=10000, ttl=3600, negative_ttl=5):
+        self.size = size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+
+    def configure(self, size, ttl, negative_ttl):
+        self.size = size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.clear()
+
+    def get(self, key):
+        item = self._items.get(key, None)
+
+        if item is None:
+            self.misses += 1
+            return MISSING
+
+        value, expires = item
+        if expires < time.monotonic():
+            del self._items[key]
+            self._discard(key)
+            self.misses += 1
+            return MISSING
+
+        self._items.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        # `None` is a cached "not found", it lives for `negative_ttl` seconds only
+        ttl = self.ttl if value is not None else self.negative_ttl
+        if self.size <= 0 or ttl <= 0:
+            return
+
+        self._items[key] = (value, time.monotonic() + ttl)
+        self._items.move_to_end(key)
+
+        while len(self._items) > self.size:
+            self._discard(self._items.popitem(last=False)[0])
+
+    def invalidate(self, key):
+        if self._items.pop(key, None) is not None:
+            self._discard(key)
+
+    def clear(self):
+        self._items.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def _discard(self, key):
+        pass
+
+    def stats(self):
+        return {
+            "size": len(self._items),
+            "hits": self.hits,
+            "misses": self.misses
+        }
+
+
+class TaggedLRUCache(LRUCache):
+    # Every value is put with a tag, `invalidate_tag` drops all values of the tag at once.
+    # `generation` changes on every invalidation: a value read before it must not be put after it
+    def __init__(self, size=1000, ttl=5, negative_ttl=0):
+        self._tags = {}
+        self._key_tags = {}
+        self.generation = 0
+        self.invalidations = 0
+        super().__init__(size, ttl, negative_ttl)
+
+    def put(self, key, value, tag=None, generation=None):
+        if generation is not None and generation != self.generation:
+            return
+
+        self._discard(key)
+
+        super().put(key, value)
+
+        if key in self._items:
+            self._key_tags[key] = tag
+            self._tags.setdefault(tag, set()).add(key)
+
+    def invalidate_tag(self, tag):
+        self.generation += 1
+
+        keys = self._tags.pop(tag, ())
+        if keys:
+            self.invalidations += 1
+
+        for key in keys:
+            self._items.pop(key, None)
+            self._key_tags.pop(key, None)
+
+    def clear(self):
+        super().clear()
+        self._tags.clear()
+        self._key_tags.clear()
+        self.invalidations = 0
+
+    def _discard(self, key):
+        if key not in self._key_tags:
+            return
+
+        tag = self._key_tags.pop(key)
+        keys = self._tags[tag]
+        keys.discard(key)
+        if not keys:
+            del self._tags[tag]
+
+    def stats(self):
+        result = super().stats()
+        result["invalidations"] = self.invalidations
+        result["hit_rate"] = self.hits / (self.hits + self.misses) if self.hits + self.misses else 0.0
+
+        return result
+
+
+class SingleFlight(object):
+    # Concurrent calls with the same key share one execution: the first caller starts it, the rest await its result
+    def __init__(self):
+        self._calls = {}
+        self.calls = 0
+        self.deduplicated = 0
+
+    async def do(self, key, function):
+        call = self._calls.get(key, None)
+
+        if call is None:
+            self.calls += 1
+
+            call = self._calls[key] = asyncio.ensure_future(function())
+            call.add_done_callback(lambda _: self._calls.pop(key, None))
+        else:
+            self.deduplicated += 1
+
+        # A cancelled caller leaves the call running for the others
+        return await asyncio.shield(call)
+
+    def stats(self):
+        return {
+            "in_flight": len(self._calls),
+            "calls": self.calls,
+            "deduplicated": self.deduplicated
+        }
@@ -1,127 +1,286 @@
+import asyncio
 from datetime import datetime
 
-from sqlalchemy import select, and_, func, desc, null
+from sqlalchemy import select, and_, or_, func, desc, null, union_all, literal, tuple_, cast, case, bindparam, true
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.exc import IntegrityError
 
+import delta
+from cache import LRUCache, MISSING
 from schema import *
 
+# Token to id mappings never change once created, so they are cached per process
+id_cache = LRUCache()
+
+PATH_SEGMENT_LENGTH = 11
+
+# Rows fetched per round trip when a listing is streamed through a server-side cursor
+stream_batch_size = 1000
+
+# Keep revisions older than the current one as deltas against their successor
+delta_revisions = False
+
+_statements = {}
+
 
 class DBException(Exception):
     pass
 
 
-async def select_or_insert(connection, query_select, field, query_insert, create_if_none=True):
-    ds = await connection.execute(query_select)
+def _keyset_clause(created_column, id_column):
+    created, comment_id = bindparam("cursor_created"), bindparam("cursor_id")
 
-    if ds.rowcount:
-        result = (await ds.first())[field]
-    else:
-        if create_if_none:
-            async with connection.begin_nested() as trans:
-                result = (await connection.execute(query_insert)).inserted_primary_key[0]
+    return or_(
+        created_column < created,
+        and_(created_column == created, id_column < comment_id)
+    )
 
-                await trans.commit()
-        else:
-            result = None
 
-    return result
+def _statement(builder, *flags, stream=False):
+    # Listings are built once per combination of optional filters and then executed with bound parameters,
+    # so the engine's `compiled_cache` keeps their SQL compiled once per dialect
+    key = (builder, stream and stream_batch_size) + flags
 
+    query = _statements.get(key, None)
+    if query is None:
+        query = builder(*flags)
 
-async def get_or_create_entity_type(connection, type_name, create_if_none=True):
-    query_select = select([
-        entity_type.c.id.label("type_id")
-    ]).select_from(
-        entity_type
-    ).where(
-        entity_type.c.name == type_name.lower()
-    )
+        if stream:
+            # Server-side cursor: rows are pulled in batches, so memory stays flat for any result size.
+            # SQLAlchemy fetches 1, 5, 10 ... rows from the cursor and grows the batch up to `max_row_buffer`,
+            # but never past 1000 rows
+            query = query.execution_options(stream_results=True, max_row_buffer=stream_batch_size)
+
+        _statements[key] = query
+
+    return query
+
+
+def _paginate(query, has_limit, has_offset):
+    if has_limit:
+        query = query.limit(bindparam("limit", type_=Integer))
+
+    if has_offset:
+        query = query.offset(bindparam("offset", type_=Integer))
+
+    return query
+
+
+def _listing_params(limit, offset, timestamp_from=None, timestamp_to=None, cursor=None):
+    params = {}
 
-    query_insert = entity_type.insert().values(
-        name=type_name.lower()
+    if limit:
+        params["limit"] = limit
+
+    if offset:
+        params["offset"] = offset
+
+    if timestamp_from:
+        params["timestamp_from"] = timestamp_from
+
+    if timestamp_to:
+        params["timestamp_to"] = timestamp_to
+
+    if cursor:
+        params["cursor_created"], params["cursor_id"] = cursor
+
+    return params
+
+
+async def _fetch(connection, query, params):
+    ds = await connection.execute(query, params)
+    try:
+        rows = await ds.fetchmany(stream_batch_size)
+        if not rows:
+            raise DBException("Data not found")
+
+        while rows:
+            for row in rows:
+                yield dict(row)
+
+            rows = await ds.fetchmany(stream_batch_size)
+    finally:
+        await ds.close()
+
+
+def path_segment(comment_id):
+    return "{:010d}/".format(comment_id)
+
+
+def _dialect_name(connection):
+    # sqlalchemy_aio does not proxy `dialect`, take it from the wrapped connection
+    return connection._connection.dialect.name
+
+
+async def _select_id(connection, table, where_clause):
+    return await connection.scalar(
+        select([table.c.id]).where(where_clause)
     )
 
-    return await select_or_insert(connection, query_select, "type_id", query_insert, create_if_none)
 
+async def _upsert_id(connection, table, values, where_clause):
+    dialect_name = _dialect_name(connection)
 
-async def get_or_create_entity(connection, type_id, token, create_if_none=True):
-    query_select = select([
-        entity.c.id.label("entity_id")
-    ]).select_from(
-        entity
-    ).where(
-        and_(
-            entity.c.type == type_id,
-            entity.c.token == token
+    if dialect_name == "postgresql":
+        # One round trip: the CTE inserts the row unless it exists, the second branch finds an existing one
+        inserted = postgresql.insert(table).values(**values).on_conflict_do_nothing(
+            index_elements=list(values.keys())
+        ).returning(table.c.id).cte("inserted")
+
+        result = await connection.scalar(
+            union_all(
+                select([inserted.c.id]),
+                select([table.c.id]).where(where_clause)
+            ).limit(1).execution_options(autocommit=True)
         )
-    )
 
-    query_insert = entity.insert().values(
-        type=type_id,
-        token=token
-    )
+        if result is not None:
+            return result
 
-    return await select_or_insert(connection, query_select, "entity_id", query_insert, create_if_none)
+        # Row was inserted by a concurrent transaction which committed after our snapshot was taken
+        return await _select_id(connection, table, where_clause)
+    elif dialect_name in ("sqlite", "mysql"):
+        await connection.execute(
+            table.insert().values(**values).prefix_with("OR IGNORE" if dialect_name == "sqlite" else "IGNORE")
+        )
+
+        return await _select_id(connection, table, where_clause)
+    else:
+        result = await _select_id(connection, table, where_clause)
+        if result is not None:
+            return result
 
+        try:
+            async with connection.begin_nested() as trans:
+                result = (await connection.execute(table.insert().values(**values))).inserted_primary_key[0]
+
+                await trans.commit()
+
+                return result
+        except IntegrityError:
+            return await _select_id(connection, table, where_clause)
+
+
+async def select_or_insert(connection, cache_key, table, values, create_if_none=True):
+    result = id_cache.get(cache_key)
+    if result is not MISSING and (result is not None or not create_if_none):
+        return result
+
+    where_clause = and_(*[table.c[name] == value for name, value in values.items()])
+
+    if create_if_none:
+        result = await _upsert_id(connection, table, values, where_clause)
+    else:
+        result = await _select_id(connection, table, where_clause)
+
+    id_cache.put(cache_key, result)
+
+    return result
 
-async def get_or_create_user(connection, token, create_if_none=True):
-    query_select = select([
-        user.c.id.label("user_id")
-    ]).select_from(
-        user
-    ).where(
-        user.c.token == token
-    )
 
-    query_insert = user.insert().values(
-        token=token
+async def get_or_create_entity_type(connection, type_name, create_if_none=True):
+    return await select_or_insert(
+        connection,
+        ("entity_type", type_name.lower()),
+        entity_type,
+        {"name": type_name.lower()},
+        create_if_none
     )
 
-    return await select_or_insert(connection, query_select, "user_id", query_insert, create_if_none)
 
+async def get_or_create_entity(connection, type_id, token, create_if_none=True):
+    return await select_or_insert(
+        connection,
+        ("entity", type_id, token),
+        entity,
+        {"type": type_id, "token": token},
+        create_if_none
+    )
 
-async def get_user_id_by_token(connection, token):
-    query_select = select([
-        user.c.id.label("user_id")
-    ]).select_from(
-        user
-    ).where(
-        user.c.token == token
+
+async def get_or_create_user(connection, token, create_if_none=True):
+    return await select_or_insert(
+        connection,
+        ("user", token),
+        user,
+        {"token": token},
+        create_if_none
     )
 
-    ds = await connection.execute(query_select)
-    if ds.rowcount:
-        return (await ds.first())["user_id"]
-    else:
-        return None
+
+async def get_user_id_by_token(connection, token):
+    return await get_or_create_user(connection, token, create_if_none=False)
 
 
 async def add_or_update_comment_text(connection, comment_id, text, text_hash):
-    subquery = select([
-        func.max(comment_text.c.id).label("max_id")
-    ]).select_from(
-        comment_text
-    ).where(
-        comment_text.c.comment == comment_id
-    ).alias("comment_text_max_id")
-
     query = select([
-        comment_text.c.hash.label("hash")
+        comment_text.c.id,
+        comment_text.c.hash,
+        comment_text.c.data
     ]).select_from(
-        comment_text
+        comment.join(
+            comment_text,
+            comment_text.c.id == comment.c.revision
+        )
     ).where(
-        comment_text.c.id == subquery.c.max_id
+        comment.c.id == comment_id
     )
 
+    previous_id, previous_delta = None, None
+    if delta_revisions:
+        # The diff is slow for long texts: it runs in a worker thread and before the comment row is locked
+        unlocked = await (await connection.execute(query)).first()
+
+        if unlocked is not None and unlocked["hash"] != text_hash:
+            previous_id = unlocked["id"]
+            previous_delta = await asyncio.get_event_loop().run_in_executor(
+                None, delta.compress, text, unlocked["data"]
+            )
+
     async with connection.begin_nested() as trans:
-        if await connection.scalar(query) != text_hash:
+        # The comment row stays locked until the end of the transaction, so concurrent edits of a comment
+        # go one after another. The current revision is read by a separate statement after the lock is taken,
+        # so it is the one committed by the previous edit
+        await connection.scalar(
+            select([comment.c.id]).where(comment.c.id == comment_id).with_for_update()
+        )
+
+        current = await (await connection.execute(query)).first()
+
+        if current is None or current["hash"] != text_hash:
+            timestamp = datetime.now()
+
             result = (await connection.execute(
                 comment_text.insert().values(
                     comment=comment_id,
-                    timestamp=datetime.now(),
+                    timestamp=timestamp,
                     hash=text_hash,
                     data=text
                 )
             )).inserted_primary_key[0]
 
+            await connection.execute(
+                comment.update().values(
+                    revision=result,
+                    created=func.coalesce(comment.c.created, timestamp),
+                    updated=timestamp
+                ).where(
+                    comment.c.id == comment_id
+                )
+            )
+
+            # Only the current revision is kept in full, the previous one becomes a delta against it. A revision
+            # replaced by a concurrent edit after the diff was taken stays in full
+            if previous_delta is not None and current is not None and current["id"] == previous_id:
+                await connection.execute(
+                    comment_text.update().values(
+                        data=previous_delta,
+                        delta=True
+                    ).where(
+                        comment_text.c.id == current["id"]
+                    )
+                )
+
             await trans.commit()
 
             return result
@@ -129,23 +288,548 @@ async def add_or_update_comment_text(connection, comment_id, text, text_hash):
             return None
 
 
-async def insert_comment(connection, entity_id, user_id, unique_key, text, text_hash, parent_comment_id=None):
+async def get_comment_history(connection, comment_id):
+    rows = await (await connection.execute(
+        select([
+            comment_text.c.id,
+            comment_text.c.timestamp,
+            comment_text.c.data,
+            comment_text.c.delta
+        ]).where(
+            comment_text.c.comment == comment_id
+        ).order_by(
+            desc(comment_text.c.id)
+        )
+    )).fetchall()
+
+    if not rows:
+        raise DBException("Data not found")
+
+    result = []
+    successor = None
+    for row in rows:
+        # Deltas are chained from the newest revision backwards, the newest one is always stored in full
+        text = delta.decode(successor, row["data"]) if row["delta"] else row["data"]
+
+        result.append({"id": row["id"], "timestamp": row["timestamp"], "text": text})
+        successor = text
+
+    return result
+
+
+def _counter_deltas(rows):
+    entity_deltas, user_deltas = {}, {}
+
+    for entity_id, user_id, parent_comment_id, sign in rows:
+        entity_delta = entity_deltas.setdefault(entity_id, {"comments": 0, "total": 0})
+        entity_delta["total"] += sign
+        if parent_comment_id is None:
+            entity_delta["comments"] += sign
+
+        user_delta = user_deltas.setdefault(user_id, {"total": 0})
+        user_delta["total"] += sign
+
+    return entity_deltas, user_deltas
+
+
+def _counter_upsert_query(table, key_column, deltas):
+    # PostgreSQL: a single statement for all keys of `deltas`, a sorted list of (key, values)
+    query = postgresql.insert(table).values([
+        {key_column.name: key, **values} for key, values in deltas
+    ])
+
+    return query.on_conflict_do_update(
+        index_elements=[key_column],
+        set_={name: table.c[name] + query.excluded[name] for name in deltas[0][1]}
+    )
+
+
+def _counter_update_query(table, key_column, key, values):
+    return table.update().values(
+        {name: table.c[name] + value for name, value in values.items()}
+    ).where(
+        key_column == key
+    )
+
+
+async def _add_to_counter(connection, table, key_column, deltas):
+    if not deltas:
+        return
+
+    # Counter rows are locked in the order of their keys, so concurrent batches touching the same rows
+    # wait for each other instead of deadlocking
+    deltas = sorted(deltas.items())
+
+    if _dialect_name(connection) == "postgresql":
+        await connection.execute(_counter_upsert_query(table, key_column, deltas))
+        return
+
+    for key, values in deltas:
+        query = _counter_update_query(table, key_column, key, values)
+
+        if (await connection.execute(query)).rowcount:
+            continue
+
+        try:
+            async with connection.begin_nested():
+                await connection.execute(table.insert().values({key_column.name: key, **values}))
+        except IntegrityError:
+            # Counter row was created by a concurrent transaction
+            await connection.execute(query)
+
+
+async def update_counters(connection, rows):
+    # `rows` are (entity id, user id, parent comment id, +1 or -1) of inserted or deleted comments
+    entity_deltas, user_deltas = _counter_deltas(rows)
+
+    await _add_to_counter(connection, entity_counter, entity_counter.c.entity, entity_deltas)
+    await _add_to_counter(connection, user_counter, user_counter.c.user, user_deltas)
+
+
+def update_counter_deltas(connection, entity_deltas, user_deltas):
+    # `update_counters` for the synchronous connections of maintenance scripts, which know the deltas themselves:
+    # {entity id: {"comments": ..., "total": ...}} and {user id: {"total": ...}}
+    for table, key_column, deltas in [(entity_counter, entity_counter.c.entity, entity_deltas),
+                                      (user_counter, user_counter.c.user, user_deltas)]:
+        if not deltas:
+            continue
+
+        deltas = sorted(deltas.items())
+
+        if connection.dialect.name == "postgresql":
+            connection.execute(_counter_upsert_query(table, key_column, deltas))
+            continue
+
+        for key, values in deltas:
+            query = _counter_update_query(table, key_column, key, values)
+
+            if connection.execute(query).rowcount:
+                continue
+
+            try:
+                with connection.begin_nested():
+                    connection.execute(table.insert().values({key_column.name: key, **values}))
+            except IntegrityError:
+                connection.execute(query)
+
+
+async def get_entity_counters(connection, entity_id):
+    row = await (await connection.execute(
+        select([
+            entity_counter.c.comments,
+            entity_counter.c.total
+        ]).where(
+            entity_counter.c.entity == entity_id
+        )
+    )).first()
+
+    return dict(row) if row else {"comments": 0, "total": 0}
+
+
+def _entity_version_query():
+    entity_id = bindparam("entity_id", type_=Integer)
+
+    # Edits and new comments raise the latest revision, removals and detached replies change the counters
+    return select([
+        select([
+            func.max(comment.c.revision)
+        ]).where(
+            comment.c.entity == entity_id
+        ).as_scalar().label("revision"),
+        entity_counter.c.comments,
+        entity_counter.c.total
+    ]).where(
+        entity_counter.c.entity == entity_id
+    )
+
+
+async def get_entity_version(connection, entity_id):
+    row = await (await connection.execute(_statement(_entity_version_query), entity_id=entity_id)).first()
+
+    return (row["revision"], row["comments"], row["total"]) if row else (None, 0, 0)
+
+
+async def get_entities_counters(connection, entity_ids):
+    rows = await (await connection.execute(
+        select([
+            entity_counter.c.entity,
+            entity_counter.c.comments,
+            entity_counter.c.total
+        ]).where(
+            entity_counter.c.entity.in_(list(entity_ids))
+        )
+    )).fetchall()
+
+    result = {entity_id: {"comments": 0, "total": 0} for entity_id in entity_ids}
+    for row in rows:
+        result[row["entity"]] = {"comments": row["comments"], "total": row["total"]}
+
+    return result
+
+
+async def get_user_counters(connection, user_id):
+    total = await connection.scalar(
+        select([user_counter.c.total]).where(user_counter.c.user == user_id)
+    )
+
+    return {"total": total or 0}
+
+
+async def insert_comment(connection, entity_id, user_id, unique_key, text, text_hash, parent_comment_id=None,
+                         parent_path=""):
+    timestamp = datetime.now()
+
     async with connection.begin_nested() as trans:
         result = (await connection.execute(
             comment.insert().values(
                 entity=entity_id,
                 user=user_id,
                 key=unique_key,
-                comment=parent_comment_id
+                comment=parent_comment_id,
+                created=timestamp,
+                updated=timestamp
+            )
+        )).inserted_primary_key[0]
+
+        text_id = (await connection.execute(
+            comment_text.insert().values(
+                comment=result,
+                timestamp=timestamp,
+                hash=text_hash,
+                data=text
             )
         )).inserted_primary_key[0]
-        await add_or_update_comment_text(connection, result, text, text_hash)
+
+        await connection.execute(
+            comment.update().values(
+                revision=text_id,
+                path=parent_path + path_segment(result)
+            ).where(
+                comment.c.id == result
+            )
+        )
+
+        await update_counters(connection, [(entity_id, user_id, parent_comment_id, 1)])
 
         await trans.commit()
 
         return result
 
 
+def _resolve_id_cte(name, cached_id, table, values, where_clause):
+    if cached_id is not MISSING and cached_id is not None:
+        return select([literal(cached_id).label("id")]).cte(name)
+
+    inserted = postgresql.insert(table).from_select(
+        list(values.keys()),
+        select(list(values.values()))
+    ).on_conflict_do_nothing(
+        index_elements=list(values.keys())
+    ).returning(table.c.id).cte("{}_inserted".format(name))
+
+    return union_all(
+        select([inserted.c.id]),
+        select([table.c.id]).where(where_clause)
+    ).limit(1).cte(name)
+
+
+def _counter_increment_cte(name, table, values):
+    key_column, *counter_columns = values.keys()
+
+    query = postgresql.insert(table).from_select(
+        list(values.keys()),
+        select(list(values.values()))
+    )
+
+    return query.on_conflict_do_update(
+        index_elements=[key_column],
+        set_={column: table.c[column] + query.excluded[column] for column in counter_columns}
+    ).returning(table.c[key_column]).cte(name)
+
+
+async def _insert_entity_comment_statement(connection, type_name, entity_token, user_token, unique_key, text,
+                                           text_hash):
+    type_name = type_name.lower()
+    timestamp = datetime.now()
+
+    cached_type_id = id_cache.get(("entity_type", type_name))
+
+    type_id = _resolve_id_cte(
+        "type_id",
+        cached_type_id,
+        entity_type,
+        {"name": literal(type_name)},
+        entity_type.c.name == type_name
+    )
+
+    entity_id = _resolve_id_cte(
+        "entity_id",
+        id_cache.get(("entity", cached_type_id, entity_token)) if cached_type_id is not MISSING else MISSING,
+        entity,
+        {"type": type_id.c.id, "token": literal(entity_token)},
+        and_(entity.c.type == type_id.c.id, entity.c.token == entity_token)
+    )
+
+    user_id = _resolve_id_cte(
+        "user_id",
+        id_cache.get(("user", user_token)),
+        user,
+        {"token": literal(user_token)},
+        user.c.token == user_token
+    )
+
+    # Both keys are allocated up front, so that `comment` and `comment_text` can reference each other
+    new_ids = select([
+        func.nextval(func.pg_get_serial_sequence(comment.name, comment.c.id.name)).label("comment_id"),
+        func.nextval(func.pg_get_serial_sequence(comment_text.name, comment_text.c.id.name)).label("text_id")
+    ]).cte("new_ids")
+
+    comment_inserted = comment.insert().from_select(
+        ["id", "entity", "user", "key", "revision", "created", "updated", "path"],
+        select([
+            new_ids.c.comment_id,
+            entity_id.c.id,
+            user_id.c.id,
+            literal(unique_key),
+            new_ids.c.text_id,
+            literal(timestamp),
+            literal(timestamp),
+            func.lpad(cast(new_ids.c.comment_id, Text), PATH_SEGMENT_LENGTH - 1, "0").concat("/")
+        ])
+    ).returning(comment.c.id, comment.c.entity, comment.c.user).cte("comment_inserted")
+
+    text_inserted = comment_text.insert().from_select(
+        ["id", "comment", "timestamp", "hash", "data"],
+        select([
+            new_ids.c.text_id,
+            comment_inserted.c.id,
+            literal(timestamp),
+            literal(text_hash),
+            literal(text)
+        ])
+    ).returning(comment_text.c.id).cte("text_inserted")
+
+    entity_counted = _counter_increment_cte("entity_counted", entity_counter, {
+        "entity": comment_inserted.c.entity, "comments": literal(1), "total": literal(1)
+    })
+    user_counted = _counter_increment_cte("user_counted", user_counter, {
+        "user": comment_inserted.c.user, "total": literal(1)
+    })
+
+    query = select([
+        comment_inserted.c.id.label("comment_id"),
+        text_inserted.c.id.label("text_id"),
+        type_id.c.id.label("type_id"),
+        entity_id.c.id.label("entity_id"),
+        user_id.c.id.label("user_id")
+    ]).select_from(
+        # Counter CTEs return a single row each, they are listed only to make them part of the statement
+        comment_inserted.join(entity_counted, true()).join(user_counted, true())
+    ).execution_options(autocommit=True)
+
+    row = await (await connection.execute(query)).first()
+    if not row:
+        # Some of the ids were inserted by a concurrent transaction which committed after our snapshot was taken
+        return None
+
+    id_cache.put(("entity_type", type_name), row["type_id"])
+    id_cache.put(("entity", row["type_id"], entity_token), row["entity_id"])
+    id_cache.put(("user", user_token), row["user_id"])
+
+    return row["comment_id"], row["entity_id"]
+
+
+async def insert_entity_comment(connection, type_name, entity_token, user_token, unique_key, text, text_hash):
+    # Returns the ids of the comment and of its entity
+    if _dialect_name(connection) == "postgresql":
+        result = await _insert_entity_comment_statement(
+            connection, type_name, entity_token, user_token, unique_key, text, text_hash
+        )
+
+        if result is not None:
+            return result
+
+    type_id = await get_or_create_entity_type(connection, type_name)
+    entity_id = await get_or_create_entity(connection, type_id, entity_token)
+    user_id = await get_or_create_user(connection, user_token)
+
+    comment_id = await insert_comment(
+        connection,
+        entity_id=entity_id,
+        user_id=user_id,
+        unique_key=unique_key,
+        text=text,
+        text_hash=text_hash
+    )
+
+    return comment_id, entity_id
+
+
+async def _resolve_ids(connection, table, columns, keys, create_if_none=True):
+    result = {}
+    missing = []
+
+    for key in keys:
+        cached = id_cache.get((table.name,) + key)
+        if cached is MISSING or cached is None:
+            missing.append(key)
+        else:
+            result[key] = cached
+
+    if not missing:
+        return result
+
+    if len(columns) == 1:
+        where_clause = table.c[columns[0]].in_([key[0] for key in missing])
+    else:
+        where_clause = tuple_(*[table.c[column] for column in columns]).in_(missing)
+
+    query_select = select([table.c.id] + [table.c[column] for column in columns]).where(where_clause)
+
+    dialect_name = _dialect_name(connection)
+    if not create_if_none:
+        query_insert = None
+    elif dialect_name == "postgresql":
+        query_insert = postgresql.insert(table).on_conflict_do_nothing(index_elements=columns)
+    elif dialect_name in ("sqlite", "mysql"):
+        query_insert = table.insert().prefix_with("OR IGNORE" if dialect_name == "sqlite" else "IGNORE")
+    else:
+        existing = {tuple(row[column] for column in columns) for row in await (
+            await connection.execute(query_select)
+        ).fetchall()}
+        missing = [key for key in missing if key not in existing]
+        query_insert = table.insert()
+
+    if missing and create_if_none:
+        await connection.execute(query_insert, [dict(zip(columns, key)) for key in missing])
+
+    for row in await (await connection.execute(query_select)).fetchall():
+        key = tuple(row[column] for column in columns)
+        id_cache.put((table.name,) + key, row["id"])
+        result[key] = row["id"]
+
+    return result
+
+
+async def get_or_create_entity_types(connection, type_names, create_if_none=True):
+    result = await _resolve_ids(
+        connection, entity_type, ["name"], {(name.lower(),) for name in type_names}, create_if_none
+    )
+
+    return {name: type_id for (name,), type_id in result.items()}
+
+
+async def get_or_create_entities(connection, type_tokens, create_if_none=True):
+    return await _resolve_ids(connection, entity, ["type", "token"], set(type_tokens), create_if_none)
+
+
+async def get_or_create_users(connection, tokens):
+    result = await _resolve_ids(connection, user, ["token"], {(token,) for token in tokens})
+
+    return {token: user_id for (token,), user_id in result.items()}
+
+
+async def insert_comments(connection, rows):
+    timestamp = datetime.now()
+
+    async with connection.begin_nested() as trans:
+        if _dialect_name(connection) == "postgresql":
+            # Allocate all keys with one query, so that both tables are filled without reading ids back
+            new_ids = await (await connection.execute(
+                select([
+                    func.nextval(func.pg_get_serial_sequence(comment.name, comment.c.id.name)).label("comment_id"),
+                    func.nextval(func.pg_get_serial_sequence(comment_text.name, comment_text.c.id.name)).label(
+                        "text_id")
+                ]).select_from(
+                    func.generate_series(1, len(rows))
+                )
+            )).fetchall()
+
+            await connection.execute(comment.insert(), [
+                {
+                    "id": ids["comment_id"],
+                    "entity": row["entity_id"],
+                    "user": row["user_id"],
+                    "comment": row["parent_comment_id"],
+                    "key": row["unique_key"],
+                    "revision": ids["text_id"],
+                    "created": timestamp,
+                    "updated": timestamp,
+                    "path": row["parent_path"] + path_segment(ids["comment_id"])
+                } for row, ids in zip(rows, new_ids)
+            ])
+
+            await connection.execute(comment_text.insert(), [
+                {
+                    "id": ids["text_id"],
+                    "comment": ids["comment_id"],
+                    "timestamp": timestamp,
+                    "hash": row["text_hash"],
+                    "data": row["text"]
+                } for row, ids in zip(rows, new_ids)
+            ])
+        else:
+            await connection.execute(comment.insert(), [
+                {
+                    "entity": row["entity_id"],
+                    "user": row["user_id"],
+                    "comment": row["parent_comment_id"],
+                    "key": row["unique_key"],
+                    "created": timestamp,
+                    "updated": timestamp
+                } for row in rows
+            ])
+
+            comment_ids = {row["key"]: row["id"] for row in await (await connection.execute(
+                select([
+                    comment.c.id,
+                    comment.c.key
+                ]).where(
+                    comment.c.key.in_([row["unique_key"] for row in rows])
+                )
+            )).fetchall()}
+
+            await connection.execute(comment_text.insert(), [
+                {
+                    "comment": comment_ids[row["unique_key"]],
+                    "timestamp": timestamp,
+                    "hash": row["text_hash"],
+                    "data": row["text"]
+                } for row in rows
+            ])
+
+            await connection.execute(
+                comment.update().values(
+                    revision=select([
+                        func.max(comment_text.c.id)
+                    ]).where(
+                        comment_text.c.comment == comment.c.id
+                    ).as_scalar()
+                ).where(
+                    comment.c.id.in_(list(comment_ids.values()))
+                )
+            )
+
+            await connection.execute(
+                comment.update().values(
+                    path=bindparam("new_path")
+                ).where(
+                    comment.c.id == bindparam("comment_id")
+                ), [
+                    {
+                        "comment_id": comment_ids[row["unique_key"]],
+                        "new_path": row["parent_path"] + path_segment(comment_ids[row["unique_key"]])
+                    } for row in rows
+                ]
+            )
+
+        await update_counters(connection, [
+            (row["entity_id"], row["user_id"], row["parent_comment_id"], 1) for row in rows
+        ])
+
+        await trans.commit()
+
+
 async def get_comment_by_key(connection, unique_key):
     query = select([
         comment
@@ -162,6 +846,18 @@ async def get_comment_by_key(connection, unique_key):
         return None
 
 
+async def get_comments_by_keys(connection, unique_keys):
+    query = select([
+        comment
+    ]).select_from(
+        comment
+    ).where(
+        comment.c.key.in_(list(unique_keys))
+    )
+
+    return {row["key"]: dict(row) for row in await (await connection.execute(query)).fetchall()}
+
+
 async def delete_comment(connection, comment_id):
     query = select([func.count()]).select_from(comment).where(
         comment.c.comment == comment_id
@@ -171,78 +867,44 @@ async def delete_comment(connection, comment_id):
         if await connection.scalar(query) > 0:
             return False
         else:
+            row = await (await connection.execute(
+                select([
+                    comment.c.entity,
+                    comment.c.user,
+                    comment.c.comment
+                ]).where(
+                    comment.c.id == comment_id
+                )
+            )).first()
+
             await connection.execute(
                 comment.delete().where(
                     comment.c.id == comment_id
                 )
             )
 
+            await update_counters(connection, [(row["entity"], row["user"], row["comment"], -1)])
+
             await trans.commit()
 
             return True
 
 
-async def get_entity_comments(connection, entity_id, with_replies, limit, offset, timestamp_from=None,
-                              timestamp_to=None):
-    comment_where_clause = comment.c.entity == entity_id
-    if not with_replies:
-        comment_where_clause = and_(
-            comment_where_clause,
-            comment.c.comment.is_(None)
-        )
-
-    comment_text_max_id = select([
-        func.max(comment_text.c.id).label("max_id"),
-        func.min(comment_text.c.timestamp).label("created"),
-        func.max(comment_text.c.timestamp).label("updated"),
-        comment_text.c.comment
-    ]).select_from(
-        comment_text
-    ).group_by(
-        comment_text.c.comment
-    ).alias("comment_text_max_id")
-
-    text_data_where_clause = comment_text.c.id == comment_text_max_id.c.max_id
-
-    if timestamp_from:
-        text_data_where_clause = and_(
-            text_data_where_clause,
-            comment_text_max_id.c.created >= timestamp_from
-        )
-
-    if timestamp_to:
-        text_data_where_clause = and_(
-            text_data_where_clause,
-            comment_text_max_id.c.created <= timestamp_to
-        )
-
-    comment_text_last_data = select([
-        comment_text.c.data.label("text"),
-        comment_text_max_id.c.created,
-        comment_text_max_id.c.updated,
-        comment_text.c.comment
-    ]).select_from(
-        comment_text.join(
-            comment_text_max_id,
-            comment_text.c.comment == comment_text_max_id.c.comment
-        )
-    ).where(
-        text_data_where_clause
-    ).alias("comment_text_last_data")
-
+def _entity_comments_select(where_clause, *extra_columns):
     comment2 = comment.alias("comment2")
 
-    query = select([
-        comment_text_last_data.c.text,
-        comment_text_last_data.c.created,
-        comment_text_last_data.c.updated,
+    return select([
+        comment.c.id,
+        comment_text.c.data.label("text"),
+        comment.c.created,
+        comment.c.updated,
         user.c.token,
         comment.c.key,
         comment2.c.key.label("parent_key")
-    ]).select_from(
+    ] + list(extra_columns)).select_from(
         comment.join(
-            comment_text_last_data,
-            comment_text_last_data.c.comment == comment.c.id
+            comment_text,
+            comment_text.c.id == comment.c.revision
         ).join(
             user, user.c.id == comment.c.user
         ).join(
@@ -251,178 +913,263 @@ async def get_entity_comments(connection, entity_id, with_replies, limit, offset
             isouter=True
         )
     ).where(
-        comment_where_clause
-    ).order_by(
-        desc(comment_text_last_data.c.created)
+        where_clause
     )
 
-    if limit:
-        query = query.limit(limit)
 
-    if offset:
-        query = query.offset(offset)
+def _entity_comments_query(with_replies, has_from, has_to, has_cursor, has_limit, has_offset):
+    where_clause = comment.c.entity == bindparam("entity_id")
+    if not with_replies:
+        where_clause = and_(
+            where_clause,
+            comment.c.comment.is_(None)
+        )
 
-    ds = await connection.execute(query)
+    if has_from:
+        where_clause = and_(
+            where_clause,
+            comment.c.created >= bindparam("timestamp_from"),
+            # Redundant, the current revision is never older than the comment, but lets comment_text partitions
+            # older than the window be pruned
+            comment_text.c.timestamp >= bindparam("timestamp_from")
+        )
 
-    if ds.rowcount:
-        async for item in ds:
-            yield dict(item)
-    else:
-        raise DBException("Data not found")
+    if has_to:
+        where_clause = and_(
+            where_clause,
+            comment.c.created <= bindparam("timestamp_to")
+        )
 
+    if has_cursor:
+        where_clause = and_(
+            where_clause,
+            _keyset_clause(comment.c.created, comment.c.id)
+        )
 
-async def get_user_comments(connection, user_id, limit, offset, timestamp_from=None, timestamp_to=None):
-    comment_text_max_id = select([
-        func.max(comment_text.c.id).label("max_id"),
-        func.min(comment_text.c.timestamp).label("created"),
-        func.max(comment_text.c.timestamp).label("updated"),
-        comment_text.c.comment
-    ]).select_from(
-        comment_text
-    ).group_by(
-        comment_text.c.comment
-    ).alias("comment_text_max_id")
+    query = _entity_comments_select(
+        where_clause
+    ).order_by(
+        desc(comment.c.created),
+        desc(comment.c.id)
+    )
 
-    comment_text_last_data = select([
-        comment_text.c.data.label("text"),
-        comment_text_max_id.c.created,
-        comment_text_max_id.c.updated,
-        comment_text.c.comment
-    ]).select_from(
-        comment_text.join(
-            comment_text_max_id,
-            comment_text.c.comment == comment_text_max_id.c.comment
+    return _paginate(query, has_limit, has_offset)
+
+
+def _entities_first_page_query(lateral):
+    # Same page as `get_entity_comments` returns for each of the entities, so that all of them are read at once
+    if lateral:
+        # A page per entity, each one read from the (entity, created) index up to its limit
+        page = _entity_comments_select(
+            and_(
+                comment.c.entity == entity.c.id,
+                comment.c.comment.is_(None)
+            ),
+            comment.c.entity
+        ).order_by(
+            desc(comment.c.created),
+            desc(comment.c.id)
+        ).limit(
+            bindparam("limit")
+        ).lateral("page")
+
+        return select([
+            page
+        ]).select_from(
+            entity.join(page, true())
+        ).where(
+            entity.c.id.in_(bindparam("entity_ids", expanding=True))
+        ).order_by(
+            page.c.entity,
+            desc(page.c.created),
+            desc(page.c.id)
         )
-    ).where(
-        comment_text.c.id == comment_text_max_id.c.max_id
-    ).alias("comment_text_last_data")
 
-    text_data_where_clause = comment_text_last_data.c.comment == comment.c.id
+    # Without LATERAL the comments are numbered per entity
+    ranked = _entity_comments_select(
+        and_(
+            comment.c.entity.in_(bindparam("entity_ids", expanding=True)),
+            comment.c.comment.is_(None)
+        ),
+        comment.c.entity,
+        func.row_number().over(
+            partition_by=comment.c.entity,
+            order_by=(desc(comment.c.created), desc(comment.c.id))
+        ).label("position")
+    ).alias("ranked")
+
+    return select([
+        ranked
+    ]).where(
+        ranked.c.position <= bindparam("limit")
+    ).order_by(
+        ranked.c.entity,
+        ranked.c.position
+    )
+
 
-    if timestamp_from:
-        text_data_where_clause = and_(
-            text_data_where_clause,
-            comment_text_max_id.c.created >= timestamp_from
+async def get_entity_comments(connection, entity_id, with_replies, limit, offset, timestamp_from=None,
+                              timestamp_to=None, cursor=None, stream=False):
+    query = _statement(
+        _entity_comments_query,
+        bool(with_replies), bool(timestamp_from), bool(timestamp_to), bool(cursor), bool(limit), bool(offset),
+        stream=stream
+    )
+
+    params = _listing_params(limit, offset, timestamp_from, timestamp_to, cursor)
+    params["entity_id"] = entity_id
+
+    async for item in _fetch(connection, query, params):
+        yield item
+
+
+async def get_entities_first_page(connection, entity_ids, limit):
+    result = {entity_id: [] for entity_id in entity_ids}
+    if not entity_ids:
+        return result
+
+    ds = await connection.execute(
+        _statement(_entities_first_page_query, _dialect_name(connection) == "postgresql"),
+        {"entity_ids": list(entity_ids), "limit": limit}
+    )
+
+    for row in await ds.fetchall():
+        result[row["entity"]].append(dict(row))
+
+    return result
+
+
+def _user_comments_query(has_from, has_to, has_cursor, has_limit, has_offset):
+    where_clause = comment.c.user == bindparam("user_id")
+
+    if has_from:
+        where_clause = and_(
+            where_clause,
+            comment.c.created >= bindparam("timestamp_from"),
+            # Redundant, the current revision is never older than the comment, but lets comment_text partitions
+            # older than the window be pruned
+            comment_text.c.timestamp >= bindparam("timestamp_from")
         )
 
-    if timestamp_to:
-        text_data_where_clause = and_(
-            text_data_where_clause,
-            comment_text_max_id.c.created <= timestamp_to
+    if has_to:
+        where_clause = and_(
+            where_clause,
+            comment.c.created <= bindparam("timestamp_to")
+        )
+
+    if has_cursor:
+        where_clause = and_(
+            where_clause,
+            _keyset_clause(comment.c.created, comment.c.id)
         )
 
     query = select([
-        comment_text_last_data.c.text,
-        comment_text_last_data.c.created,
-        comment_text_last_data.c.updated,
+        comment.c.id,
+        comment_text.c.data.label("text"),
+        comment.c.created,
+        comment.c.updated,
         entity.c.token.label("entity_token"),
         entity_type.c.name.label("entity_type")
     ]).select_from(
         comment.join(
-            comment_text_last_data, text_data_where_clause
+            comment_text,
+            comment_text.c.id == comment.c.revision
         ).join(
             entity, entity.c.id == comment.c.entity
         ).join(
             entity_type, entity_type.c.id == entity.c.type
         )
     ).where(
-        comment.c.user == user_id
+        where_clause
     ).order_by(
-        desc(comment_text_last_data.c.created)
+        desc(comment.c.created),
+        desc(comment.c.id)
     )
 
-    if limit:
-        query = query.limit(limit)
+    return _paginate(query, has_limit, has_offset)
 
-    if offset:
-        query = query.offset(offset)
 
-    ds = await connection.execute(query)
+async def get_user_comments(connection, user_id, limit, offset, timestamp_from=None, timestamp_to=None,
+                            cursor=None, stream=False):
+    query = _statement(
+        _user_comments_query,
+        bool(timestamp_from), bool(timestamp_to), bool(cursor), bool(limit), bool(offset),
+        stream=stream
+    )
 
-    if ds.rowcount:
-        async for item in ds:
-            yield dict(item)
-    else:
-        raise DBException("Data not found")
+    params = _listing_params(limit, offset, timestamp_from, timestamp_to, cursor)
+    params["user_id"] = user_id
 
+    async for item in _fetch(connection, query, params):
+        yield item
 
-async def get_comment_replies(connection, comment_id, limit, offset):
-    comment_text_max_id = select([
-        func.max(comment_text.c.id).label("max_id"),
-        func.min(comment_text.c.timestamp).label("created"),
-        func.max(comment_text.c.timestamp).label("updated"),
-        comment_text.c.comment
-    ]).select_from(
-        comment_text
-    ).group_by(
-        comment_text.c.comment
-    ).alias("comment_text_max_id")
 
-    comment_text_last_data = select([
-        comment_text.c.data.label("text"),
-        comment_text_max_id.c.created,
-        comment_text_max_id.c.updated,
-        comment_text.c.comment
-    ]).select_from(
-        comment_text.join(
-            comment_text_max_id,
-            comment_text.c.comment == comment_text_max_id.c.comment
-        )
-    ).where(
-        comment_text.c.id == comment_text_max_id.c.max_id
-    ).alias("comment_text_last_data")
+def _comment_replies_query(has_depth, has_cursor, has_limit, has_offset):
+    # Subtree is a prefix range of paths, ordered the way the thread reads
+    where_clause = comment.c.path.like(bindparam("path_prefix"))
 
-    comment_recursive = select([
-        comment.c.id,
-        comment.c.user,
-        comment.c.comment,
-        comment.c.key,
-        null().label("parent_key")
-    ]).where(
-        comment.c.id == comment_id
-    ).cte("comment_recursive", recursive=True)
+    if has_depth:
+        where_clause = and_(
+            where_clause,
+            func.length(comment.c.path) <= bindparam("max_path_length")
+        )
 
-    comment_recursive = comment_recursive.union(
-        select([
-            comment.c.id,
-            comment.c.user,
-            comment.c.comment,
-            comment.c.key,
-            comment_recursive.c.key.label("parent_key")
-        ]).select_from(
-            comment.join(
-                comment_recursive, comment.c.comment == comment_recursive.c.id
-            )
+    if has_cursor:
+        where_clause = and_(
+            where_clause,
+            comment.c.path > bindparam("cursor_path")
         )
-    )
+
+    comment2 = comment.alias("comment2")
 
     query = select([
-        comment_text_last_data.c.text,
-        comment_text_last_data.c.created,
-        comment_text_last_data.c.updated,
-        comment_recursive.c.key,
-        comment_recursive.c.parent_key,
-        user.c.token.label("user")
+        comment.c.id,
+        comment_text.c.data.label("text"),
+        comment.c.created,
+        comment.c.updated,
+        comment.c.key,
+        case(
+            [(comment.c.id == bindparam("root_id"), null())],
+            else_=comment2.c.key
+        ).label("parent_key"),
+        user.c.token.label("user"),
+        comment.c.path
     ]).select_from(
-        comment_text_last_data.join(
-            comment_recursive,
-            comment_text_last_data.c.comment == comment_recursive.c.id
+        comment.join(
+            comment_text,
+            comment_text.c.id == comment.c.revision
         ).join(
             user,
-            user.c.id == comment_recursive.c.user
+            user.c.id == comment.c.user
+        ).join(
+            comment2,
+            comment2.c.id == comment.c.comment,
+            isouter=True
         )
+    ).where(
+        where_clause
+    ).order_by(
+        comment.c.path
     )
 
-    if limit:
-        query = query.limit(limit)
+    return _paginate(query, has_limit, has_offset)
 
-    if offset:
-        query = query.offset(offset)
 
-    ds = await connection.execute(query)
+async def get_comment_replies(connection, root_comment, limit, offset, cursor=None, depth=None):
+    query = _statement(
+        _comment_replies_query,
+        depth is not None, bool(cursor), bool(limit), bool(offset)
+    )
 
-    if ds.rowcount:
-        async for item in ds:
-            yield dict(item)
-    else:
-        raise DBException("Data not found")
+    # `cursor` is the path of the last comment read
+    params = _listing_params(limit, offset)
+    params["path_prefix"] = root_comment["path"] + "%"
+    if cursor:
+        params["cursor_path"] = cursor
+    params["root_id"] = root_comment["id"]
+
+    if depth is not None:
+        params["max_path_length"] = len(root_comment["path"]) + depth * PATH_SEGMENT_LENGTH
+
+    async for item in _fetch(connection, query, params):
+        yield item
@@ -0,0 +1,127 @@
+import asyncio
+from itertools import cycle
+
+from sqlalchemy import create_engine
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.util import LRUCache as CompiledCache
+from sqlalchemy_aio import ASYNCIO_STRATEGY
+
+from cache import LRUCache, MISSING
+
+
+class ConnectionPool(object):
+    def __init__(self, url, min_size=1, max_size=10, max_overflow=10, timeout=30, compiled_cache_size=500):
+        self.min_size = min_size
+
+        options = {}
+        dialect = make_url(url).get_dialect()
+        if dialect.driver == "psycopg2":
+            # Send `executemany` parameter sets in pages instead of one round trip per row
+            options["use_batch_mode"] = True
+        elif dialect.name == "sqlite":
+            # SQLite defaults to pools which take no size arguments, and its connections are used from worker threads
+            options["poolclass"] = QueuePool
+            options["connect_args"] = {"check_same_thread": False}
+
+        self.engine = create_engine(
+            url,
+            strategy=ASYNCIO_STRATEGY,
+            pool_size=max_size,
+            max_overflow=max_overflow,
+            pool_timeout=timeout,
+            # Statements built once by `db_api` are compiled once per engine and reused by identity
+            execution_options={"compiled_cache": CompiledCache(compiled_cache_size)},
+            **options
+        )
+
+    @property
+    def sync_engine(self):
+        return self.engine._engine
+
+    async def warm_up(self):
+        # Open `min_size` connections at once and hand them back to the pool,
+        # so first requests do not pay for the connection handshake
+        connections = await asyncio.gather(
+            *[self.engine.connect() for _ in range(self.min_size)], return_exceptions=True
+        )
+
+        for connection in connections:
+            if not isinstance(connection, BaseException):
+                await connection.close()
+
+        for connection in connections:
+            if isinstance(connection, BaseException):
+                raise connection
+
+    def acquire(self):
+        return _PooledConnection(self.engine)
+
+
+class _PooledConnection(object):
+    def __init__(self, engine):
+        self.engine = engine
+        self.connection = None
+
+    async def __aenter__(self):
+        try:
+            self.connection = await self.engine.connect()
+        except PoolTimeoutError:
+            raise TimeoutError("Connection pool checkout timeout expired")
+
+        return self.connection
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.connection.close()
+
+
+class DatabaseRouter(object):
+    def __init__(self, primary, replicas=None, read_your_writes_window=5, read_your_writes_size=100000):
+        self.primary = primary
+        self.replicas = replicas or []
+        self._replicas = cycle(self.replicas)
+        # User tokens which wrote recently, their reads stay on the primary until replicas catch up
+        self._writers = LRUCache(size=read_your_writes_size, ttl=read_your_writes_window)
+
+    @property
+    def pools(self):
+        return [self.primary] + self.replicas
+
+    async def warm_up(self):
+        for pool in self.pools:
+            await pool.warm_up()
+
+    def write_pool(self, user_tokens=()):
+        if self.replicas:
+            for user_token in user_tokens:
+                self._writers.put(user_token, True)
+
+        return self.primary
+
+    def read_pool(self, user_tokens=()):
+        if not self.replicas:
+            return self.primary
+
+        if any(self._writers.get(user_token) is not MISSING for user_token in user_tokens):
+            return self.primary
+
+        return next(self._replicas)
+
+
+def create_pool(url, env):
+    return ConnectionPool(
+        url,
+        min_size=int(env.get("DATABASE_POOL_MIN_SIZE", "1")),
+        max_size=int(env.get("DATABASE_POOL_MAX_SIZE", "10")),
+        max_overflow=int(env.get("DATABASE_POOL_MAX_OVERFLOW", "10")),
+        timeout=float(env.get("DATABASE_POOL_TIMEOUT", "30"))
+    )
+
+
+def create_router(url, read_urls, env):
+    return DatabaseRouter(
+        create_pool(url, env),
+        [create_pool(read_url.strip(), env) for read_url in (read_urls or "").split(",") if read_url.strip()],
+        read_your_writes_window=float(env.get("DATABASE_READ_YOUR_WRITES_WINDOW", "5"))
+    )
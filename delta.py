@@ -0,0 +1,41 @@
+import json
+from difflib import SequenceMatcher
+
+
+def encode(source, target):
+    # Ops rebuilding `target` from `source`: [start, end] copies a slice of `source`, a string is inserted as is
+    ops = []
+
+    for tag, i1, i2, j1, j2 in SequenceMatcher(None, source, target, autojunk=False).get_opcodes():
+        if tag == "equal":
+            ops.append([i1, i2])
+        elif tag in ("replace", "insert"):
+            ops.append(target[j1:j2])
+
+    return json.dumps(ops, ensure_ascii=False, separators=(",", ":"))
+
+
+def decode(source, delta):
+    return "".join(
+        op if isinstance(op, str) else source[op[0]:op[1]] for op in json.loads(delta)
+    )
+
+
+# The diff takes quadratic time, longer texts are kept in full
+max_length = 4000
+
+# Texts whose characters match less than this are unrelated, their delta would not be shorter
+min_ratio = 0.5
+
+
+def compress(source, target):
+    # Delta of `target` against `source`, or `None` when the delta would not be shorter than `target` itself
+    if len(source) > max_length or len(target) > max_length:
+        return None
+
+    if SequenceMatcher(None, source, target, autojunk=False).quick_ratio() < min_ratio:
+        return None
+
+    result = encode(source, target)
+
+    return result if len(result) < len(target) else None
@@ -0,0 +1,248 @@
+from sqlalchemy import inspect, select, func, and_, or_, bindparam, case, desc
+
+import delta
+from schema import *
+
+
+def _add_missing_columns(engine, table):
+    existing = {column["name"] for column in inspect(engine).get_columns(table.name)}
+    preparer = engine.dialect.identifier_preparer
+
+    for column in table.columns:
+        if column.name not in existing:
+            engine.execute("ALTER TABLE {table} ADD COLUMN {column} {type}".format(
+                table=preparer.format_table(table),
+                column=preparer.format_column(column),
+                type=column.type.compile(engine.dialect)
+            ))
+
+
+def _create_missing_indexes(engine, table):
+    existing = {index["name"] for index in inspect(engine).get_indexes(table.name)}
+
+    for index in table.indexes:
+        if index.name not in existing:
+            index.create(engine)
+
+
+def add_comment_revision(engine):
+    _add_missing_columns(engine, comment)
+    _create_missing_indexes(engine, comment)
+
+    engine.execute(
+        comment.update().values(
+            revision=select([
+                func.max(comment_text.c.id)
+            ]).where(
+                comment_text.c.comment == comment.c.id
+            ).as_scalar(),
+            created=select([
+                func.min(comment_text.c.timestamp)
+            ]).where(
+                comment_text.c.comment == comment.c.id
+            ).as_scalar(),
+            updated=select([
+                func.max(comment_text.c.timestamp)
+            ]).where(
+                comment_text.c.comment == comment.c.id
+            ).as_scalar()
+        ).where(
+            comment.c.revision.is_(None)
+        )
+    )
+
+
+def add_comment_path(engine, batch_size=1000):
+    _add_missing_columns(engine, comment)
+    _create_missing_indexes(engine, comment)
+
+    parent = comment.alias("parent")
+
+    # Walk the forest top-down: each pass fills comments whose parent path is already known
+    while True:
+        rows = engine.execute(
+            select([
+                comment.c.id,
+                parent.c.path.label("parent_path")
+            ]).select_from(
+                comment.join(
+                    parent,
+                    parent.c.id == comment.c.comment,
+                    isouter=True
+                )
+            ).where(
+                and_(
+                    comment.c.path.is_(None),
+                    or_(
+                        comment.c.comment.is_(None),
+                        parent.c.path.isnot(None)
+                    )
+                )
+            ).limit(batch_size)
+        ).fetchall()
+
+        if not rows:
+            break
+
+        engine.execute(
+            comment.update().values(
+                path=bindparam("new_path")
+            ).where(
+                comment.c.id == bindparam("comment_id")
+            ), [
+                {
+                    "comment_id": row["id"],
+                    "new_path": (row["parent_path"] or "") + "{:010d}/".format(row["id"])
+                } for row in rows
+            ]
+        )
+
+
+def _scoped(query, column, ids):
+    return query if ids is None else query.where(column.in_(list(ids)))
+
+
+def reconcile_counters_of(connection, entity_ids=None, user_ids=None):
+    # Recompute counters of the given entities and users (all of them for `None`) from `comment`
+    if entity_ids is None or entity_ids:
+        connection.execute(_scoped(entity_counter.delete(), entity_counter.c.entity, entity_ids))
+        connection.execute(
+            entity_counter.insert().from_select(
+                ["entity", "comments", "total"],
+                _scoped(
+                    select([
+                        comment.c.entity,
+                        func.count(case([(comment.c.comment.is_(None), 1)])),
+                        func.count()
+                    ]),
+                    comment.c.entity,
+                    entity_ids
+                ).group_by(
+                    comment.c.entity
+                )
+            )
+        )
+
+    if user_ids is None or user_ids:
+        connection.execute(_scoped(user_counter.delete(), user_counter.c.user, user_ids))
+        connection.execute(
+            user_counter.insert().from_select(
+                ["user", "total"],
+                _scoped(
+                    select([
+                        comment.c.user,
+                        func.count()
+                    ]),
+                    comment.c.user,
+                    user_ids
+                ).group_by(
+                    comment.c.user
+                )
+            )
+        )
+
+
+def reconcile_counters(engine):
+    # Recompute all counters from `comment` in one transaction
+    with engine.begin() as connection:
+        reconcile_counters_of(connection)
+
+
+def add_comment_counters(engine):
+    # Counters of an existing database are filled once, when the tables are just created
+    if engine.scalar(select([func.count()]).select_from(entity_counter)) == 0:
+        reconcile_counters(engine)
+
+
+def add_comment_text_delta(engine):
+    _add_missing_columns(engine, comment_text)
+
+
+def add_comment_entity_revision(engine):
+    _create_missing_indexes(engine, comment)
+
+
+def _rewrite_revisions(engine, rewrite, batch_size):
+    # Comments with more than one revision, processed in batches of `batch_size` comments per transaction
+    query = select([
+        comment_text.c.comment
+    ]).group_by(
+        comment_text.c.comment
+    ).having(
+        func.count() > 1
+    ).order_by(
+        comment_text.c.comment
+    )
+
+    last_comment_id = None
+    while True:
+        batch_query = query if last_comment_id is None else query.where(comment_text.c.comment > last_comment_id)
+        comment_ids = [row[0] for row in engine.execute(batch_query.limit(batch_size)).fetchall()]
+
+        if not comment_ids:
+            break
+
+        with engine.begin() as connection:
+            revisions = {}
+            for row in connection.execute(
+                    select([
+                        comment_text.c.id,
+                        comment_text.c.comment,
+                        comment_text.c.data,
+                        comment_text.c.delta
+                    ]).where(
+                        comment_text.c.comment.in_(comment_ids)
+                    ).order_by(
+                        comment_text.c.comment,
+                        desc(comment_text.c.id)
+                    )
+            ):
+                revisions.setdefault(row["comment"], []).append(row)
+
+            for rows in revisions.values():
+                successor = None
+                for row in rows:
+                    text = delta.decode(successor, row["data"]) if row["delta"] else row["data"]
+
+                    values = rewrite(successor, text, row)
+                    if values is not None:
+                        connection.execute(
+                            comment_text.update().values(**values).where(comment_text.c.id == row["id"])
+                        )
+
+                    successor = text
+
+        last_comment_id = comment_ids[-1]
+
+
+def encode_revision_deltas(engine, batch_size=100):
+    def rewrite(successor, text, row):
+        if successor is None or row["delta"]:
+            return None
+
+        data = delta.compress(successor, text)
+        return {"data": data, "delta": True} if data is not None else None
+
+    _rewrite_revisions(engine, rewrite, batch_size)
+
+
+def decode_revision_deltas(engine, batch_size=100):
+    def rewrite(successor, text, row):
+        return {"data": text, "delta": None} if row["delta"] else None
+
+    _rewrite_revisions(engine, rewrite, batch_size)
+
+
+migrations = [
+    add_comment_revision,
+    add_comment_path,
+    add_comment_counters,
+    add_comment_text_delta,
+    add_comment_entity_revision
+]
+
+
+def upgrade(engine):
+    for migration in migrations:
+        print("Applying migration '{}'".format(migration.__name__))
+        migration(engine)
@@ -0,0 +1,101 @@
+from datetime import date, datetime
+
+from sqlalchemy import Column, Integer, MetaData, Table, Text, ForeignKey, DateTime, Boolean
+
+from schema import comment, comment_text
+
+DEFAULT_PARTITION = "comment_text_default"
+
+
+def _month(value, shift=0):
+    months = value.year * 12 + value.month - 1 + shift
+    return date(months // 12, months % 12 + 1, 1)
+
+
+def _partition_name(month):
+    return "comment_text_{:04d}_{:02d}".format(month.year, month.month)
+
+
+def _partitioned_comment_text():
+    # The partition key has to be a part of the primary key, so it is (id, timestamp) here;
+    # application code keeps addressing revisions by `id` only
+    return Table(
+        comment_text.name, MetaData(),
+        Column("id", Integer, primary_key=True, autoincrement=True),
+        Column("comment", ForeignKey(comment.c.id, ondelete="CASCADE"), nullable=False),
+        Column("timestamp", DateTime, primary_key=True),
+        Column("hash", Text),
+        Column("data", Text),
+        Column("delta", Boolean),
+        postgresql_partition_by="RANGE (timestamp)"
+    )
+
+
+def is_partitioned(engine):
+    return engine.scalar(
+        "SELECT relkind = 'p' FROM pg_class WHERE oid = to_regclass(%s)", comment_text.name
+    ) or False
+
+
+def create_partitioned_comment_text(engine, months_ahead=3):
+    if engine.has_table(comment_text.name):
+        if not is_partitioned(engine):
+            raise Exception("Table '{}' already exists and is not partitioned".format(comment_text.name))
+    else:
+        with engine.begin() as connection:
+            _partitioned_comment_text().create(connection)
+
+            connection.execute("CREATE TABLE {} PARTITION OF {} DEFAULT".format(DEFAULT_PARTITION, comment_text.name))
+
+            # Indexes of the parent table are created on every partition
+            for index in comment_text.indexes:
+                index.create(connection)
+
+    create_partitions(engine, months_ahead)
+
+
+def create_partitions(engine, months_ahead=3):
+    # Partitions from the current month up to `months_ahead` months later; rows which already landed
+    # in the default partition for one of those months are moved to the new partition
+    this_month = _month(datetime.now())
+
+    for shift in range(months_ahead + 1):
+        start, end = _month(this_month, shift), _month(this_month, shift + 1)
+        name = _partition_name(start)
+
+        if engine.has_table(name):
+            continue
+
+        with engine.begin() as connection:
+            in_range = "timestamp >= '{}' AND timestamp < '{}'".format(start, end)
+
+            misplaced = connection.scalar(
+                "SELECT count(*) FROM {} WHERE {}".format(DEFAULT_PARTITION, in_range)
+            )
+
+            if misplaced:
+                connection.execute("ALTER TABLE {} DETACH PARTITION {}".format(comment_text.name, DEFAULT_PARTITION))
+
+            connection.execute("CREATE TABLE {} PARTITION OF {} FOR VALUES FROM ('{}') TO ('{}')".format(
+                name, comment_text.name, start, end
+            ))
+
+            if misplaced:
+                connection.execute("INSERT INTO {} SELECT * FROM {} WHERE {}".format(
+                    comment_text.name, DEFAULT_PARTITION, in_range
+                ))
+                connection.execute("DELETE FROM {} WHERE {}".format(DEFAULT_PARTITION, in_range))
+                connection.execute("ALTER TABLE {} ATTACH PARTITION {} DEFAULT".format(
+                    comment_text.name, DEFAULT_PARTITION
+                ))
+
+        print("Partition '{}' created".format(name))
+
+
+def detach_partition(engine, month):
+    # `month` is "YYYY-MM"; the detached table keeps its rows and can be archived or dropped separately
+    name = _partition_name(datetime.strptime(month, "%Y-%m"))
+
+    engine.execute("ALTER TABLE {} DETACH PARTITION {}".format(comment_text.name, name))
+
+    print("Partition '{}' detached".format(name))
@@ -1,4 +1,5 @@
-from sqlalchemy import Column, Integer, MetaData, Table, Text, ForeignKey, UniqueConstraint, DateTime
+from sqlalchemy import Column, Integer, MetaData, Table, Text, ForeignKey, UniqueConstraint, DateTime, Index, \
+    Boolean
 
 metadata = MetaData()
 
@@ -29,6 +30,17 @@ comment = Table(
     Column("user", ForeignKey("user.id", ondelete="CASCADE"), index=True, nullable=False),
     Column("comment", ForeignKey("comment.id", ondelete="CASCADE"), index=True),
     Column("key", Text, index=True),
+    # Current revision, denormalized from `comment_text`
+    Column("revision", Integer),
+    Column("created", DateTime),
+    Column("updated", DateTime),
+    # Materialized path of the thread: ids of all ancestors and of the comment itself
+    Column("path", Text),
+    Index("ix_comment_entity_created", "entity", "created"),
+    # Latest revision of an entity's comments is read from this index alone, see `get_entity_version`
+    Index("ix_comment_entity_revision", "entity", "revision"),
+    Index("ix_comment_path", "path", postgresql_ops={"path": "text_pattern_ops"}),
+    Index("ix_comment_user_created", "user", "created"),
 )
 
 comment_text = Table(
@@ -38,4 +50,22 @@ comment_text = Table(
     Column("timestamp", DateTime, index=True, nullable=False),
     Column("hash", Text, index=True),
     Column("data", Text),
+    # `data` holds a delta against the next revision of the comment instead of the full text
+    Column("delta", Boolean),
+)
+
+# Comment counts, maintained along with `comment` so that they are read in O(1)
+entity_counter = Table(
+    "entity_counter", metadata,
+    Column("entity", ForeignKey("entity.id", ondelete="CASCADE"), primary_key=True),
+    # Top level comments only
+    Column("comments", Integer, nullable=False, default=0),
+    # Comments including replies
+    Column("total", Integer, nullable=False, default=0),
+)
+
+user_counter = Table(
+    "user_counter", metadata,
+    Column("user", ForeignKey("user.id", ondelete="CASCADE"), primary_key=True),
+    Column("total", Integer, nullable=False, default=0),
 )